@@ -1,17 +1,35 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import asyncio
+import bisect
+import codecs
+import hashlib
+import heapq
+import inspect
+import json
 import logging #日志模块
+import os
+import random
 import re
 import sqlite3
+import sys
+import threading
 import time
+import timeit
+import tracemalloc
 from abc import ABC, abstractmethod  # 抽象基类模块 定义接口规范或抽象类
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor # 进程池, CPU 密集的处理放到多核上
 from contextlib import asynccontextmanager, contextmanager #上下文管理工具
 from dataclasses import dataclass # 数据类工具
-from typing import Dict, Generator, Iterable, List, Optional #  类型注解支持库
+from typing import (AsyncIterable, AsyncIterator, Awaitable, Callable, Deque, Dict, FrozenSet,
+                    Generator, Iterable, List, NamedTuple, Optional, Tuple, TypeVar, Union) #  类型注解支持库
+from urllib.parse import urlsplit
 
 import aiohttp #异步 HTTP 客户端与服务器库
 
+T = TypeVar("T")
+
 ###########################
 ##### logging module ######
 ###########################
@@ -25,6 +43,122 @@ def setup_logging() -> None:
 
 log = logging.getLogger("crawler")
 
+###########################
+##### metrics module ######
+###########################
+
+# 直方图分桶上限(秒), 和 Prometheus 默认分桶接近, 覆盖 1ms ~ 30s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Histogram:
+    """
+    固定分桶的直方图, observe 只做一次二分查找和几个加法, 热路径上开销可以忽略
+    """
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        cum, buckets = 0, {}
+        for le, c in zip(LATENCY_BUCKETS + (float("inf"),), self.counts):
+            cum += c
+            buckets["+Inf" if le == float("inf") else str(le)] = cum
+        return {"count": self.count, "sum": round(self.total, 6), "buckets": buckets}
+
+class Metrics:
+    """
+    整个爬虫共用的指标注册表
+    stages: 各阶段耗时直方图, 比如 queue_wait / dns / connect / ttfb / body / process / sqlite_write
+    host_events: 按域名计数的事件, 比如 retry / error
+    导出为 JSON 或者 Prometheus 文本格式(给 node_exporter 的 textfile collector 用)
+    """
+    def __init__(self):
+        self.stages: Dict[str, Histogram] = {}
+        self.host_events: Counter = Counter()
+
+    def observe(self, stage: str, seconds: float) -> None:
+        h = self.stages.get(stage)
+        if h is None:
+            h = self.stages[stage] = Histogram()
+        h.observe(seconds)
+
+    def inc(self, event: str, host: str) -> None:
+        self.host_events[(event, host)] += 1
+
+    def snapshot(self) -> Dict[str, object]:
+        events: Dict[str, Dict[str, int]] = {}
+        for (event, host), n in self.host_events.items():
+            events.setdefault(event, {})[host] = n
+        return {"stages": {k: h.snapshot() for k, h in self.stages.items()}, "host_events": events}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), ensure_ascii=False)
+
+    def to_prometheus(self) -> str:
+        lines = ["# TYPE crawler_stage_seconds histogram"]
+        for stage, h in self.stages.items():
+            snap = h.snapshot()
+            for le, n in snap["buckets"].items():
+                lines.append(f'crawler_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {n}')
+            lines.append(f'crawler_stage_seconds_sum{{stage="{stage}"}} {snap["sum"]}')
+            lines.append(f'crawler_stage_seconds_count{{stage="{stage}"}} {snap["count"]}')
+        lines.append("# TYPE crawler_host_events_total counter")
+        for (event, host), n in self.host_events.items():
+            lines.append(f'crawler_host_events_total{{event="{event}",host="{host}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str) -> None:
+        """
+        先写临时文件再改名, 采集端不会读到写了一半的文件
+        """
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(tmp, path)
+
+METRICS = Metrics()
+
+def trace_config() -> aiohttp.TraceConfig:
+    """
+    aiohttp 的请求钩子, 记录 DNS 解析、建立连接、首字节(TTFB)的耗时
+    连接池复用连接时不会触发 DNS / connect 钩子, 所以这两个直方图只统计新建连接
+    """
+    async def on_request_start(session, ctx, params):
+        ctx.t0 = time.perf_counter()
+
+    async def on_dns_start(session, ctx, params):
+        ctx.dns_t0 = time.perf_counter()
+
+    async def on_dns_end(session, ctx, params):
+        METRICS.observe("dns", time.perf_counter() - ctx.dns_t0)
+
+    async def on_conn_start(session, ctx, params):
+        ctx.conn_t0 = time.perf_counter()
+
+    async def on_conn_end(session, ctx, params):
+        METRICS.observe("connect", time.perf_counter() - ctx.conn_t0)
+
+    async def on_request_end(session, ctx, params):
+        # 收到响应头时触发, 正文还没开始读
+        METRICS.observe("ttfb", time.perf_counter() - ctx.t0)
+
+    tc = aiohttp.TraceConfig()
+    tc.on_request_start.append(on_request_start)
+    tc.on_dns_resolvehost_start.append(on_dns_start)
+    tc.on_dns_resolvehost_end.append(on_dns_end)
+    tc.on_connection_create_start.append(on_conn_start)
+    tc.on_connection_create_end.append(on_conn_end)
+    tc.on_request_end.append(on_request_end)
+    return tc
+
 
 ################################
 #####  decorators module   #####
@@ -42,9 +176,10 @@ def timed(fn):
             log.debug("%s took %.2f ms", fn.__name__, (time.perf_counter()-t0)*1000)
     return _inner
 
-def retry_async(retries=3, backoff=0.5, excs=(Exception,)):
+def retry_async(retries=3, backoff=0.5, excs=(Exception,), key=None):
     """
     重试函数,第一层参数是尝试次数和等待时间,以及异常类型
+    key(args, kwargs) 返回一个标签(比如域名), 重试和最终失败次数按这个标签记到 METRICS 里
     第二层参数是修饰的函数,返回一个修饰器函数
     第三层是执行每次操作,失败打印日志,和等待时间再重试
     """
@@ -59,7 +194,11 @@ def retry_async(retries=3, backoff=0.5, excs=(Exception,)):
                     sleep = backoff * (2**i)
                     log.warning("retry %d/%d for %s: %r (sleep %.1fs)",
                                 i+1, retries, fn.__name__, e, sleep)
+                    if key is not None:
+                        METRICS.inc("retry", key(a, kw))
                     await asyncio.sleep(sleep)
+            if key is not None:
+                METRICS.inc("error", key(a, kw))
             raise last
         return wrapper
     return deco
@@ -71,12 +210,42 @@ def retry_async(retries=3, backoff=0.5, excs=(Exception,)):
 # 帮助快速定义一个结构类
 
 
-@dataclass
+# slots=True: 不生成 __dict__, 每个对象省下几百字节
+@dataclass(slots=True)
 class Page:
     url: str
     status: int
     title: str
     content: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # 为 True 表示和上次抓取的内容一样, 不需要再处理
+    unchanged: bool = False
+    # 流式抓取时不保留 content, 改为边读边算好的词频和正文哈希
+    words: Optional[Counter] = None
+    content_hash: Optional[str] = None
+
+    def release(self) -> None:
+        """
+        处理完就把正文和词频丢掉, 不用等到 Page 对象本身被回收
+        """
+        self.content = ""
+        self.words = None
+
+class ResultRow(NamedTuple):
+    """
+    一条处理结果, 本质是 tuple, 字段名不会在每一行里重复保存, 可以直接交给 executemany
+    """
+    url: str
+    title: str
+    status: int
+    top_words: str
+
+# 状态码种类很少, 相同的状态码共用一个 int 对象
+_STATUS_CODES: Dict[int, int] = {}
+
+def intern_status(code: int) -> int:
+    return _STATUS_CODES.setdefault(code, code)
 
 #################
 ## utils model ##
@@ -106,6 +275,82 @@ def tokenize(text: str) -> Generator[str, None, None]:
     for m in WORD_RE.finditer(text.lower()):
         yield m.group(0)
 
+def top_words_naive(text: str, topk: int) -> List[Tuple[str, int]]:
+    """
+    旧的做法: 逐个 token 累加到字典, 再对所有不同单词全量排序, 只作为基准测试的对照
+    """
+    freq: Dict[str, int] = {}
+    for t in tokenize(text):
+        freq[t] = freq.get(t, 0) + 1
+    return sorted(freq.items(), key=lambda kv: (-kv[1], kv[0]))[:topk]
+
+def top_words(text: str, topk: int, stopwords: FrozenSet[str] = frozenset()) -> List[Tuple[str, int]]:
+    """
+    findall 一次性切词, Counter 在 C 层计数, 停用词在选择时跳过
+    heapq.nsmallest 只做部分选择(O(n log k)), 排序规则和原来一样: 次数降序, 次数相同按单词升序
+    """
+    return select_top(Counter(WORD_RE.findall(text.lower())), topk, stopwords)
+
+def select_top(freq: Counter, topk: int, stopwords: FrozenSet[str] = frozenset()) -> List[Tuple[str, int]]:
+    """
+    从已有的词频里选出 topk, 停用词在选择时跳过, 不修改传入的 freq
+    """
+    items = freq.items()
+    if stopwords:
+        items = ((w, c) for w, c in items if w not in stopwords)
+    return heapq.nsmallest(topk, items, key=lambda kv: (-kv[1], kv[0]))
+
+# \Z 而不是 $: $ 还能匹配在末尾的 \n 前面, 那样 "word\n" 会整个被当成半个单词留下
+TRAILING_WORD_RE = re.compile(r"[A-Za-z0-9]+\Z")
+
+class IncrementalWordCounter:
+    """
+    分块喂入文本的词频统计, 和 tokenize 的切词结果一致
+    块末尾可能把一个单词切成两半, 所以末尾的半个单词先留着, 拼到下一块前面
+    """
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._tail = ""
+
+    def feed(self, text: str) -> None:
+        text = self._tail + text.lower()
+        m = TRAILING_WORD_RE.search(text)
+        if m:
+            self._tail = text[m.start():]
+            text = text[:m.start()]
+        else:
+            self._tail = ""
+        self.counts.update(WORD_RE.findall(text))
+
+    def close(self) -> Counter:
+        if self._tail:
+            self.counts[self._tail] += 1
+            self._tail = ""
+        return self.counts
+
+class TitleScanner:
+    """
+    分块查找 <title>, 找到 </title> 之后就不再扫描
+    只在前 limit 个字符里找, 防止没有标题的大页面被反复扫描
+    """
+    def __init__(self, limit: int = 64 * 1024):
+        self.limit = limit
+        self.title = "N/A"
+        self.done = False
+        self._buf = ""
+
+    def feed(self, text: str) -> None:
+        if self.done:
+            return
+        self._buf += text
+        if "</title>" in self._buf.lower():
+            self.title = extract_title(self._buf)
+            self.done = True
+            self._buf = ""
+        elif len(self._buf) > self.limit:
+            self.done = True
+            self._buf = ""
+
 ########################################
 ### OPP (面对对象编程) Fecther 爬虫模块 ###
 ########################################
@@ -120,28 +365,79 @@ class BaseFetcher(ABC):
     async def fetch(self, url: str) -> Optional[Page]:
         pass
 
+    async def persisted(self, urls: List[str]) -> None:
+        """
+        这些 url 的结果已经写进 results 表, 由 Pipeline 在落库之后调用; 默认什么也不做
+        """
+
+    def discard(self, url: str) -> None:
+        """
+        这个 url 的处理失败了, 结果不会落库; 默认什么也不做
+        """
+
 class HttpFetcher(BaseFetcher):
     """
     调用抽象类创建实例,抽象类是给实例类中的函数一个写法约束,所以定义的函数必须按照抽象类来写
     aiohttp.ClientSession : 异步HTTP客户端
     timeout 超时时间 默认8秒
+    stream=True 时走流式模式: 按 chunk_size 分块读取响应, 边读边解码、找标题、统计词频、算哈希,
+    整个页面不会完整留在内存里; 超过 max_bytes 的部分直接丢弃
+    每块的解码和分词放到线程里做, 不占着事件循环; 词频已经算好, 不需要再配 PoolProcessor
     """
-    def __init__(self, session: aiohttp.ClientSession, timeout: float = 8.0):
+    def __init__(self, session: aiohttp.ClientSession, timeout: float = 8.0, stream: bool = False,
+                 chunk_size: int = 64 * 1024, max_bytes: int = 5 * 1024 * 1024):
         self.session = session
         self.timeout = timeout
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
 
-    @retry_async(retries=3, backoff=0.4, excs=(aiohttp.ClientError, asyncio.TimeoutError))
-    async def fetch(self, url: str) -> Optional[Page]:
+    @retry_async(retries=3, backoff=0.4, excs=(aiohttp.ClientError, asyncio.TimeoutError),
+                 key=lambda a, kw: host_of(a[1]))
+    async def fetch(self, url: str, headers: Optional[Dict[str, str]] = None) -> Optional[Page]:
         """
         传入重试参数,哪些异常类会引发重试
         http请求, self.session 为 aiohttp.ClientSession的实例
         异步请求将response 放到 r 中
         异步 将 返回的结果 转化成 str格式 并忽略编码错误
-        返回一个页面对象
+        返回一个页面对象, 顺带带上 ETag / Last-Modified 给缓存层用
         """
-        async with self.session.get(url, timeout=self.timeout) as r:
+        async with self.session.get(url, timeout=self.timeout, headers=headers) as r:
+            t0 = time.perf_counter()
+            if self.stream:
+                page = await self._read_streaming(url, r)
+                METRICS.observe("body", time.perf_counter() - t0)
+                return page
             text = await r.text(errors="ignore")
-            return Page(url, r.status, extract_title(text), text)
+            METRICS.observe("body", time.perf_counter() - t0)
+            return Page(url, intern_status(r.status), extract_title(text), text,
+                        etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"))
+
+    async def _read_streaming(self, url: str, r: aiohttp.ClientResponse) -> Page:
+        try:
+            decoder = codecs.getincrementaldecoder(r.charset or "utf-8")(errors="ignore")
+        except LookupError:
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        title, words, digest = TitleScanner(), IncrementalWordCounter(), hashlib.sha1()
+
+        def feed(chunk: bytes, final: bool = False) -> None:
+            digest.update(chunk)
+            text = decoder.decode(chunk, final=final)
+            title.feed(text)
+            words.feed(text)
+
+        size = 0
+        async for chunk in r.content.iter_chunked(self.chunk_size):
+            chunk = chunk[: self.max_bytes - size]
+            size += len(chunk)
+            await asyncio.to_thread(feed, chunk)
+            if size >= self.max_bytes:
+                log.warning("Body of %s exceeds %d bytes, truncated", url, self.max_bytes)
+                break
+        feed(b"", final=True)
+        return Page(url, intern_status(r.status), title.title, "",
+                    etag=r.headers.get("ETag"), last_modified=r.headers.get("Last-Modified"),
+                    words=words.close(), content_hash=digest.hexdigest())
 
 
 #############################
@@ -150,32 +446,180 @@ class HttpFetcher(BaseFetcher):
 
 class BaseProcessor(ABC):
     @abstractmethod
-    def process(self, page: Page) -> Dict[str, str]:
+    def process(self, page: Page) -> ResultRow:
         ...
 
+    async def aprocess(self, page: Page) -> ResultRow:
+        """
+        Pipeline 调用的异步入口, 默认直接在事件循环里同步执行 process
+        CPU 重的处理器可以重写它, 把计算挪到别的进程
+        """
+        return self.process(page)
+
 class WordStatProcessor(BaseProcessor):
-    def __init__(self, topk: int = 8):
+    """
+    统计页面里出现最多的 topk 个单词, stopwords 里的单词不参与统计
+    """
+    def __init__(self, topk: int = 8, stopwords: Iterable[str] = ()):
         self.topk = topk
+        self.stopwords = frozenset(w.lower() for w in stopwords)
 
-    def process(self, page: Page) -> Dict[str, str]:
+    def process(self, page: Page) -> ResultRow:
         """
         对返回的page进行梳理
         """
-        #创建一个空字典(字符串和频次)
-        freq: Dict[str, int] = {}
-        # 将page中的内容转化成单词
-        for t in tokenize(page.content):
-            #计算出现的频次,get函数做了个比较，有就调用，没有就返回0，实际用法可以将比较部分去掉
-            freq[t] = freq.get(t, 0) + 1
-        # 对字典进行排序,key 是排序规则 ，选取前k个
-        top = sorted(freq.items(), key=lambda kv: (-kv[1], kv[0]))[: self.topk]
-        return {"url": page.url, "title": page.title, "status": str(page.status),
-                "top_words": ", ".join(f"{w}:{c}" for w, c in top)}
+        if page.words is not None:
+            top = select_top(page.words, self.topk, self.stopwords)
+        else:
+            top = top_words(page.content, self.topk, self.stopwords)
+        return ResultRow(page.url, page.title, page.status,
+                         ", ".join(f"{w}:{c}" for w, c in top))
+
+def bench_wordstat(sizes: Iterable[int] = (10_000, 100_000, 1_000_000), topk: int = 8,
+                   repeat: int = 5) -> None:
+    """
+    微基准: 用接近真实页面的 html(标签 + 正文, 词频长尾分布)对比新旧两种统计方式
+    运行: python 1st_prac.py bench
+    """
+    rnd = random.Random(42)
+    vocab = [f"w{i}" for i in range(20000)] + ["div", "class", "href", "span", "the", "and"]
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    for size in sizes:
+        words = rnd.choices(vocab, weights=weights, k=size // 6)
+        html = "<html><head><title>bench</title></head><body>" + " ".join(
+            f'<p class="x">{w}</p>' if i % 10 == 0 else w for i, w in enumerate(words)) + "</body></html>"
+        assert top_words(html, topk) == top_words_naive(html, topk)
+        t_old = min(timeit.repeat(lambda: top_words_naive(html, topk), number=1, repeat=repeat))
+        t_new = min(timeit.repeat(lambda: top_words(html, topk), number=1, repeat=repeat))
+        print(f"{len(html) / 1024:9.0f} KiB  naive {t_old * 1000:8.2f} ms  "
+              f"counter+heap {t_new * 1000:8.2f} ms  x{t_old / t_new:.1f}")
+
+def bench_memory(n: int = 10_000) -> None:
+    """
+    用 tracemalloc 对比 n 个页面的对象开销: 旧的 dataclass Page + dict 结果 vs slots Page + 元组结果
+    只统计对象本身(url/title 等字符串两边共用), 正文在两种方式下都会被释放
+    运行: python 1st_prac.py bench
+    """
+    @dataclass
+    class LegacyPage:
+        url: str
+        status: int
+        title: str
+        content: str
+
+    urls = [f"https://example.com/news/{i}" for i in range(n)]
+    titles = [f"title {i}" for i in range(n)]
+    top = "the:12, and:9, news:7"
+
+    def measure(build) -> int:
+        tracemalloc.start()
+        objs = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objs
+        return size
+
+    old_pages = measure(lambda: [LegacyPage(u, int("404"), t, "") for u, t in zip(urls, titles)])
+    new_pages = measure(lambda: [Page(u, intern_status(int("404")), t, "") for u, t in zip(urls, titles)])
+    old_rows = measure(lambda: [{"url": u, "title": t, "status": str(404), "top_words": top}
+                                for u, t in zip(urls, titles)])
+    new_rows = measure(lambda: [ResultRow(u, t, intern_status(int("404")), top) for u, t in zip(urls, titles)])
+    print(f"per {n} pages: Page {old_pages / 1024:8.0f} KiB -> {new_pages / 1024:8.0f} KiB, "
+          f"rows {old_rows / 1024:8.0f} KiB -> {new_rows / 1024:8.0f} KiB")
+
+# 进程池里的每个子进程启动时保存一份处理器, 之后只需要传 Page, 不用每次都序列化处理器
+_WORKER_PROCESSOR: Optional[BaseProcessor] = None
+
+def _init_worker(processor: BaseProcessor) -> None:
+    global _WORKER_PROCESSOR
+    _WORKER_PROCESSOR = processor
+
+def _process_batch(pages: List[Page]) -> List[ResultRow]:
+    return [_WORKER_PROCESSOR.process(p) for p in pages]
+
+class PoolProcessor(BaseProcessor):
+    """
+    把任意 BaseProcessor 放到 ProcessPoolExecutor 里跑, 分词和排序不再卡住事件循环
+    小页面(小于 small_page 个字符)先攒成一批, 攒够 batch_size 个或者等了 max_delay 秒就一起提交,
+    一次进程间通信处理多个页面; 大页面直接单独提交
+    流式抓取的页面已经带着词频(page.words), 只剩选 topk, 比把整个 Counter 序列化到子进程便宜, 直接在本进程处理
+    workers 为进程数, 默认是 CPU 核数
+    """
+    def __init__(self, inner: BaseProcessor, workers: Optional[int] = None, batch_size: int = 16,
+                 small_page: int = 32 * 1024, max_delay: float = 0.005):
+        self.inner = inner
+        self.batch_size = batch_size
+        self.small_page = small_page
+        self.max_delay = max_delay
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(inner,))
+        self._batch: List[Tuple[Page, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def process(self, page: Page) -> ResultRow:
+        return self.inner.process(page)
+
+    async def aprocess(self, page: Page) -> ResultRow:
+        if page.words is not None:
+            return self.process(page)
+        loop = asyncio.get_running_loop()
+        if len(page.content) >= self.small_page:
+            rows = await loop.run_in_executor(self.pool, _process_batch, [page])
+            return rows[0]
+        fut = loop.create_future()
+        self._batch.append((page, fut))
+        if len(self._batch) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_delay, self._flush)
+        return await fut
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+        ef = asyncio.get_running_loop().run_in_executor(
+            self.pool, _process_batch, [p for p, _ in batch])
+        ef.add_done_callback(lambda f: self._deliver(batch, f))
+
+    @staticmethod
+    def _deliver(batch: List[Tuple[Page, asyncio.Future]], f: asyncio.Future) -> None:
+        """
+        把一批的结果分发回各自的等待者, 已经被取消的等待者直接跳过
+        """
+        exc = None if f.cancelled() else f.exception()
+        rows = None if f.cancelled() or exc else f.result()
+        for i, (_, fut) in enumerate(batch):
+            if fut.done():
+                continue
+            if f.cancelled():
+                fut.cancel()
+            elif exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(rows[i])
+
+    def close(self) -> None:
+        self.pool.shutdown()
 
 ################################
 #### 持续化层 处理结果写入 数据库 ###
 ################################
 # contextmanager 将一个函数封装成上下文对象，之后可以用 with 进行读写操作,这个用法是防止程序 失败而卡死。
+RESULTS_DDL = """CREATE TABLE IF NOT EXISTS results(
+  url TEXT PRIMARY KEY, title TEXT, status INTEGER, top_words TEXT,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+
+UPSERT_SQL = """INSERT INTO results(url,title,status,top_words)
+  VALUES(?,?,?,?)
+  ON CONFLICT(url) DO UPDATE SET
+    title=excluded.title, status=excluded.status, top_words=excluded.top_words,
+    created_at=CURRENT_TIMESTAMP
+"""
+
 @contextmanager
 def sqlite_conn(path: str):
     """
@@ -185,26 +629,254 @@ def sqlite_conn(path: str):
     """
     conn = sqlite3.connect(path)
     try:
-        conn.execute("""CREATE TABLE IF NOT EXISTS results(
-          url TEXT PRIMARY KEY, title TEXT, status INTEGER, top_words TEXT,
-          created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)""")
+        conn.execute(RESULTS_DDL)
         conn.commit()
         yield conn
         conn.commit()
     finally:
         conn.close()
 
+# 流式写入:处理结果先进入有界队列,由单独的写协程按批次落库,内存不会随 url 数量增长
+_STOP = object()
+
+class SinkClosedError(RuntimeError):
+    """
+    写协程已经退出(写库或 on_flush 出错), 再 put 也写不进去; run_pool 遇到它会停止整个爬取
+    """
+
+class SqliteSink:
+    """
+    流式写库器,一个长连接 + WAL 模式
+    put() 把结果放进有界队列(满了就等待,形成背压)
+    写协程攒够 batch_size 条或者超过 flush_interval 秒就用 executemany 提交一个事务
+    写库本身放到线程里执行,不阻塞事件循环
+    """
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 1.0,
+                 maxsize: int = 1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.rows_written = 0
+        self.batches = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._t0 = 0.0
+        # 每个批次提交成功后, 用这一批的 url 回调(比如通知 Frontier 标记完成), 可以是协程函数
+        self.on_flush: Optional[Callable[[List[str]], Optional[Awaitable[None]]]] = None
+
+    async def __aenter__(self) -> "SqliteSink":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.close()
+
+    async def start(self) -> None:
+        """
+        打开长连接,WAL 让读写互不阻塞, synchronous=NORMAL 在 WAL 下足够安全且更快
+        """
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(RESULTS_DDL)
+        self._conn.commit()
+        self._t0 = time.perf_counter()
+        self._task = asyncio.create_task(self._writer())
+
+    async def put(self, row: ResultRow) -> None:
+        await self._put(row)
+
+    async def _put(self, item) -> None:
+        """
+        入队; 队列满时同时等写协程, 写协程挂了(写库或 on_flush 出错)就抛出 SinkClosedError,
+        不会让生产者永远卡在一个没人消费的满队列上
+        """
+        if self._task is None:
+            await self.queue.put(item)
+            return
+        self._raise_if_dead()
+        if not self.queue.full():
+            self.queue.put_nowait(item)
+            return
+        put = asyncio.ensure_future(self.queue.put(item))
+        try:
+            await asyncio.wait({put, self._task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not put.done():
+                put.cancel()
+        if not put.done() or put.cancelled():
+            self._raise_if_dead()
+
+    def _raise_if_dead(self) -> None:
+        if self._task.done():
+            exc = None if self._task.cancelled() else self._task.exception()
+            raise SinkClosedError("SqliteSink writer has stopped") from exc
+
+    async def close(self) -> None:
+        """
+        发送结束标记,等写协程把剩余数据刷完再关闭连接
+        写协程出过错时抛出它的异常
+        """
+        try:
+            if self._task is not None:
+                if not self._task.done():
+                    await self._put(_STOP)
+                await self._task
+        finally:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def _flush(self, batch: List[ResultRow]) -> None:
+        t0 = time.perf_counter()
+        with self._conn:  # 一个批次一个事务,异常时自动回滚
+            self._conn.executemany(UPSERT_SQL, batch)
+        METRICS.observe("sqlite_write", time.perf_counter() - t0)
+
+    async def _writer(self) -> None:
+        loop = asyncio.get_running_loop()
+        batch: List[ResultRow] = []
+        deadline = loop.time() + self.flush_interval
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(),
+                                              max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                item = None
+            if item is not None and item is not _STOP:
+                batch.append(item)
+            if batch and (item is None or item is _STOP or len(batch) >= self.batch_size):
+                await asyncio.to_thread(self._flush, batch)
+                self.rows_written += len(batch)
+                self.batches += 1
+                if self.on_flush is not None:
+                    res = self.on_flush([r.url for r in batch])
+                    if inspect.isawaitable(res):
+                        await res
+                batch = []
+            if item is None or not batch:
+                deadline = loop.time() + self.flush_interval
+            if item is _STOP:
+                return
+
+    def stats(self) -> Dict[str, float]:
+        """
+        写入计数器: 总行数, 批次数, 每秒写入行数
+        """
+        elapsed = max(time.perf_counter() - self._t0, 1e-9)
+        return {"rows": self.rows_written, "batches": self.batches,
+                "queued": self.queue.qsize(),
+                "rows_per_sec": round(self.rows_written / elapsed, 2)}
+
+##################
+## 条件请求缓存层 ##
+##################
+
+FETCH_CACHE_DDL = """CREATE TABLE IF NOT EXISTS fetch_cache(
+  url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT,
+  fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"""
+
+class CachingFetcher(BaseFetcher):
+    """
+    包在 HttpFetcher 外面的持久化缓存, 和 results 表放在同一个库里
+    每个 url 记住 ETag / Last-Modified / 内容哈希, 再次抓取时带上 If-None-Match / If-Modified-Since
+    hits: 服务器返回 304, 没有下载正文
+    revalidated: 服务器返回了正文, 但哈希和上次一样
+    misses: 新 url 或者内容变了, 需要重新处理
+    前两种情况返回的 Page.unchanged 为 True, Pipeline 会跳过 process
+    新内容的 ETag / 哈希先放在内存里, 等 Pipeline 通知结果已经落库(persisted)才写进 fetch_cache;
+    处理失败或者中途崩溃时缓存里还是旧的校验值, 下次会重新下载和处理, 不会被误判成 unchanged
+    读写 fetch_cache 都放到线程里, 和 SqliteSink 抢库锁时不会卡住事件循环
+    """
+    def __init__(self, inner: HttpFetcher, db_path: str = "news.db"):
+        self.inner = inner
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        # 同一个连接会被多个线程用到, 每次操作串行
+        self._db_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(FETCH_CACHE_DDL)
+        self.conn.commit()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        # url -> (etag, last_modified, 哈希), 等结果落库后再写
+        self._pending: Dict[str, Tuple[Optional[str], Optional[str], str]] = {}
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def _lookup(self, url: str) -> Optional[Tuple[Optional[str], Optional[str], str]]:
+        with self._db_lock:
+            return self.conn.execute(
+                "SELECT etag, last_modified, content_hash FROM fetch_cache WHERE url=?", (url,)).fetchone()
+
+    def _save(self, rows: List[Tuple[str, Optional[str], Optional[str], str]]) -> None:
+        with self._db_lock, self.conn:
+            self.conn.executemany("""INSERT INTO fetch_cache(url,etag,last_modified,content_hash)
+              VALUES(?,?,?,?)
+              ON CONFLICT(url) DO UPDATE SET
+                etag=excluded.etag, last_modified=excluded.last_modified,
+                content_hash=excluded.content_hash, fetched_at=CURRENT_TIMESTAMP
+            """, rows)
+
+    async def persisted(self, urls: List[str]) -> None:
+        rows = [(u, *self._pending.pop(u)) for u in urls if u in self._pending]
+        if rows:
+            await asyncio.to_thread(self._save, rows)
+
+    def discard(self, url: str) -> None:
+        self._pending.pop(url, None)
+
+    async def fetch(self, url: str) -> Optional[Page]:
+        row = await asyncio.to_thread(self._lookup, url)
+        headers: Dict[str, str] = {}
+        if row:
+            if row[0]:
+                headers["If-None-Match"] = row[0]
+            if row[1]:
+                headers["If-Modified-Since"] = row[1]
+        p = await self.inner.fetch(url, headers=headers or None)
+        if p is None:
+            return None
+        if p.status == 304 and row:
+            self.hits += 1
+            p.unchanged = True
+            return p
+        digest = p.content_hash or hashlib.sha1(p.content.encode("utf-8", "ignore")).hexdigest()
+        if row and row[2] == digest:
+            self.revalidated += 1
+            p.unchanged = True
+            # 内容没变, results 里已经有这一行, 新的校验值可以直接写
+            if p.status == 200:
+                await asyncio.to_thread(self._save, [(p.url, p.etag, p.last_modified, digest)])
+        else:
+            self.misses += 1
+            if p.status == 200:
+                self._pending[p.url] = (p.etag, p.last_modified, digest)
+        return p
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "revalidated": self.revalidated}
+
 ################
 ## 异步对话处理 ##
 ################
 # asynccontextmanager 和 contextmanager 一样可以使用with操作
 @asynccontextmanager
-async def http_session(header:str = "MiniCrawler/1.0"):
+async def http_session(header:str = "MiniCrawler/1.0", limit: int = 100,
+                       limit_per_host: int = 8, ttl_dns_cache: int = 300):
     """
     创建一个会话对象, 相当于 requests 里的 requests.Session()
     headers 这里需要更像一个真实的浏览器才不容易被封
+    connector: limit 是总连接数, limit_per_host 是单个域名的连接上限,
+    ttl_dns_cache 秒内同一个域名不再重复做 DNS 解析
     """
-    async with aiohttp.ClientSession(headers={f"User-Agent": header}) as s:
+    connector = aiohttp.TCPConnector(limit=limit, limit_per_host=limit_per_host,
+                                     use_dns_cache=True, ttl_dns_cache=ttl_dns_cache)
+    async with aiohttp.ClientSession(headers={f"User-Agent": header}, connector=connector,
+                                     trace_configs=[trace_config()]) as s:
         yield s
 
 
@@ -221,48 +893,528 @@ async def http_session(header:str = "MiniCrawler/1.0"):
 #         yield session
 
 
+###############
+## 调度模块 ###
+###############
+
+UrlSource = Union[Iterable[str], AsyncIterable[str]]
+
+async def aiter_urls(urls: UrlSource) -> AsyncIterator[str]:
+    """
+    把同步/异步的 url 来源统一成异步迭代器,按需一个个取,不会一次性展开
+    """
+    if hasattr(urls, "__aiter__"):
+        async for u in urls:
+            yield u
+    else:
+        for u in urls:
+            yield u
+
+async def run_pool(urls: UrlSource, handle: Callable[[str], Awaitable[None]],
+                   concurrency: int = 10, queue_size: Optional[int] = None) -> None:
+    """
+    固定 concurrency 个常驻 worker,从有界队列里取 url 处理
+    生产者懒加载 url,队列满了就等待(背压),所以内存和 url 总数无关
+    url 取完后给每个 worker 发一个结束标记,等队列里剩余的任务处理完(优雅退出)
+    外部取消或者生产者出错时,取消所有 worker 再把异常抛出去
+    单个 url 失败只记日志,不影响其他 url; 但结果已经没法写入(SinkClosedError)时整个停下, 不再白爬
+    队列里每项带着入队时间, 取出时记录 queue_wait
+    """
+    q: asyncio.Queue = asyncio.Queue(queue_size or concurrency * 2)
+
+    async def producer():
+        async for u in aiter_urls(urls):
+            await q.put((u, time.perf_counter()))
+        for _ in range(concurrency):
+            await q.put(_STOP)
+
+    async def worker():
+        while True:
+            item = await q.get()
+            if item is _STOP:
+                return
+            u, t_put = item
+            METRICS.observe("queue_wait", time.perf_counter() - t_put)
+            try:
+                await handle(u)
+            except SinkClosedError:
+                raise
+            except Exception as e:
+                log.error("Failed on %s: %r", u, e)
+
+    tasks = [asyncio.create_task(producer())]
+    tasks += [asyncio.create_task(worker()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+##################
+## 按域名礼貌调度 ##
+##################
+
+def host_of(url: str) -> str:
+    return urlsplit(url).netloc.lower()
+
+class TokenBucket:
+    """
+    令牌桶限速: 每秒补充 rate 个令牌, 最多攒 burst 个
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def delay(self) -> float:
+        """
+        距离下一个令牌还要等多少秒
+        """
+        self._refill()
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def full_in(self) -> float:
+        """
+        距离令牌攒满还要多少秒; 攒满之后和新建的桶没有区别
+        """
+        self._refill()
+        return (self.burst - self.tokens) / self.rate
+
+class HostScheduler:
+    """
+    按域名分桶的调度器, 放在 url 来源和 run_pool 之间
+    每个域名一个待爬队列, 同时在飞的请求不超过 per_host 个, 速度受令牌桶 rate/burst 限制
+    dispatch() 在所有域名之间轮询, 哪个域名有空位和令牌就先放哪个, 忙的域名不会卡住其他域名
+    所以总吞吐随着域名数量增长, 而不是被最忙的那个域名拖住
+    max_pending 限制缓冲在调度器里的 url 总数, 保证内存有上限
+    域名空闲(没有待爬也没有在飞)后就删掉它的队列和计数; 令牌桶等攒满再删, 删早了等于白送一批令牌
+    所以内存只和最近活跃的域名数有关, 不会随爬过的域名总数增长
+    """
+    def __init__(self, per_host: int = 2, rate: float = 2.0, burst: int = 2,
+                 max_pending: int = 10000):
+        if rate <= 0:
+            raise ValueError(f"rate must be > 0, got {rate!r}")
+        if burst < 1 or per_host < 1:
+            raise ValueError(f"burst and per_host must be >= 1, got {burst!r}, {per_host!r}")
+        self.per_host = per_host
+        self.rate = rate
+        self.burst = burst
+        self._pending: Dict[str, Deque[str]] = {}
+        self._inflight: Dict[str, int] = {}
+        self._buckets: Dict[str, TokenBucket] = {}
+        # 已经空闲、但令牌桶还没攒满的域名, (攒满的时间, 域名), 按时间先后
+        self._idle: Deque[Tuple[float, str]] = deque()
+        self._ring: Deque[str] = deque()
+        self._space = asyncio.Semaphore(max_pending)
+        self._changed = asyncio.Event()
+
+    async def _feed(self, urls: UrlSource) -> None:
+        async for u in aiter_urls(urls):
+            await self._space.acquire()
+            self._sweep()
+            h = host_of(u)
+            q = self._pending.get(h)
+            if q is None:
+                q = self._pending[h] = deque()
+                self._buckets.setdefault(h, TokenBucket(self.rate, self.burst))
+            if not q:
+                self._ring.append(h)
+            q.append(u)
+            self._changed.set()
+
+    def _pick(self) -> Optional[str]:
+        """
+        从轮询环里找第一个有空位且有令牌的域名, 取出它的一个 url
+        """
+        for _ in range(len(self._ring)):
+            h = self._ring[0]
+            self._ring.rotate(-1)
+            if self._inflight.get(h, 0) < self.per_host and self._buckets[h].try_acquire():
+                q = self._pending[h]
+                u = q.popleft()
+                if not q:
+                    self._ring.remove(h)
+                self._inflight[h] = self._inflight.get(h, 0) + 1
+                self._space.release()
+                return u
+        return None
+
+    def _wait_hint(self) -> Optional[float]:
+        # 只有在令牌不够时才需要定时醒来, 连接数占满的情况由 done() 唤醒
+        delays = [self._buckets[h].delay() for h in self._ring
+                  if self._inflight.get(h, 0) < self.per_host]
+        return min(delays) if delays else None
+
+    async def dispatch(self, urls: UrlSource) -> AsyncIterator[str]:
+        feeder = asyncio.create_task(self._feed(urls))
+        try:
+            while True:
+                u = self._pick()
+                if u is not None:
+                    yield u
+                    continue
+                if feeder.done() and not self._ring:
+                    feeder.result()
+                    return
+                self._changed.clear()
+                waits = [asyncio.ensure_future(self._changed.wait())]
+                if not feeder.done():
+                    waits.append(feeder)
+                await asyncio.wait(waits, timeout=self._wait_hint(),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                waits[0].cancel()
+        finally:
+            feeder.cancel()
+
+    def done(self, url: str) -> None:
+        """
+        一个 url 处理完(无论成功失败)都要调用, 释放这个域名的在飞名额
+        """
+        h = host_of(url)
+        self._inflight[h] -= 1
+        if not self._inflight[h] and not self._pending.get(h):
+            self._evict(h)
+        self._changed.set()
+
+    def _evict(self, h: str) -> None:
+        del self._inflight[h]
+        self._pending.pop(h, None)
+        wait = self._buckets[h].full_in()
+        if wait <= 0:
+            del self._buckets[h]
+        else:
+            self._idle.append((time.monotonic() + wait, h))
+
+    def _sweep(self) -> None:
+        """
+        删掉令牌已经攒满、期间也没有再来 url 的空闲域名的令牌桶
+        """
+        now = time.monotonic()
+        while self._idle and self._idle[0][0] <= now:
+            _, h = self._idle.popleft()
+            if h not in self._pending and h not in self._inflight and h in self._buckets:
+                if self._buckets[h].full_in() <= 0:
+                    del self._buckets[h]
+
+    def stats(self) -> Dict[str, int]:
+        return {"hosts": len(self._buckets), "pending_hosts": len(self._ring),
+                "inflight": sum(self._inflight.values())}
+
+##################
+## 可续爬的 frontier ##
+##################
+
+FRONTIER_DDL = """CREATE TABLE IF NOT EXISTS frontier(
+  url TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+  updated_at REAL, done_at REAL)"""
+
+FRONTIER_INDEX = "CREATE INDEX IF NOT EXISTS frontier_state ON frontier(state, attempts)"
+
+class Frontier:
+    """
+    持久化的待爬队列, 和 results 表放在同一个库里
+    state: pending(待爬) / inflight(已领取) / done(完成) / failed(失败次数用完), attempts 记录领取次数
+    种子 url 分块写进表里, 爬的时候按 claim_batch 一批批领取, 所以种子列表不需要全部放在内存
+    recrawl_after 秒内完成过的 url 不会再爬; 为 None 时完成过的 url 永远跳过
+    attempts 达到 max_attempts 的 url 标记为 failed 不再领取; 之后再 add 同一个 url 时重新放回 pending,
+    设置了 recrawl_after 的话要等失败之后过了这个窗口, 所以一个站点挂了几天, 它的 url 也不会永远被跳过
+    完成标记先缓存, 领取下一批时一起提交; 中途崩溃最多重爬一批(至少一次语义)
+    有结果要写库的 url, 等结果真正落库之后才标记完成, 见 Pipeline
+    所有读写都放到线程里, 和 SqliteSink 抢库锁(最多等 timeout 秒)时不会卡住事件循环
+    """
+    def __init__(self, path: str, claim_batch: int = 100, recrawl_after: Optional[float] = None,
+                 max_attempts: int = 3):
+        self.claim_batch = claim_batch
+        self.recrawl_after = recrawl_after
+        self.max_attempts = max_attempts
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # 同一个连接会被多个线程用到, 每次操作串行
+        self._db_lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(FRONTIER_DDL)
+        self.conn.execute(FRONTIER_INDEX)
+        self.conn.commit()
+        self._done: List[str] = []
+        self._failed: List[str] = []
+        # add 每提交一块就 set 一下, 边加边领取时用来唤醒领取方
+        self._added = asyncio.Event()
+
+    async def _db(self, fn: Callable[..., T], *args) -> T:
+        def locked() -> T:
+            with self._db_lock:
+                return fn(*args)
+        return await asyncio.to_thread(locked)
+
+    async def close(self) -> None:
+        await self.flush()
+        await self._db(self.conn.close)
+
+    def _recover(self) -> int:
+        with self.conn:
+            self.conn.execute("UPDATE frontier SET state='failed' WHERE state IN ('pending', 'inflight') "
+                              "AND attempts >= ?", (self.max_attempts,))
+            return self.conn.execute(
+                "UPDATE frontier SET state='pending' WHERE state='inflight'").rowcount
+
+    async def recover(self) -> int:
+        """
+        上次运行被打断时领取了但没做完的 url, 放回 pending; 领取次数已经用完的标记为 failed
+        """
+        n = await self._db(self._recover)
+        if n:
+            log.info("Frontier recovered %d in-flight urls", n)
+        return n
+
+    def _write(self, sql: str, rows: List[tuple]) -> None:
+        with self.conn:
+            self.conn.executemany(sql, rows)
+
+    async def add(self, urls: UrlSource, chunk: int = 1000, max_delay: float = 1.0) -> None:
+        """
+        分块写入种子 url, 已存在的 url 不重复插入; 攒够 chunk 个或者距第一个超过 max_delay 秒就提交一块
+        设置了 recrawl_after 时, 完成时间早于这个窗口的 url 重新置为 pending
+        failed 的 url 重新置为 pending 并清零 attempts; 设置了 recrawl_after 时要失败时间早于这个窗口
+        """
+        cutoff = time.time() - self.recrawl_after if self.recrawl_after is not None else None
+        done_cutoff = cutoff if cutoff is not None else float("-inf")
+        failed_cutoff = cutoff if cutoff is not None else float("inf")
+        sql = """INSERT INTO frontier(url, state, updated_at) VALUES(?, 'pending', ?)
+          ON CONFLICT(url) DO UPDATE SET state='pending', attempts=0, updated_at=excluded.updated_at
+          WHERE (frontier.state='done' AND frontier.done_at < ?)
+             OR (frontier.state='failed' AND frontier.updated_at < ?)"""
+        buf: List[Tuple[str, float, float, float]] = []
+        t_first = 0.0
+        async for u in aiter_urls(urls):
+            if not buf:
+                t_first = time.monotonic()
+            buf.append((u, time.time(), done_cutoff, failed_cutoff))
+            if len(buf) >= chunk or time.monotonic() - t_first >= max_delay:
+                await self._db(self._write, sql, buf)
+                self._added.set()
+                buf = []
+        if buf:
+            await self._db(self._write, sql, buf)
+            self._added.set()
+
+    def _mark(self, done: List[str], failed: List[str]) -> None:
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE frontier SET state='done', updated_at=?, done_at=? WHERE url=?",
+                [(now, now, u) for u in done])
+            self.conn.executemany(
+                "UPDATE frontier SET state=CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+                "updated_at=? WHERE url=?",
+                [(self.max_attempts, now, u) for u in failed])
+
+    async def flush(self) -> None:
+        """
+        把缓存的完成/失败标记一次性提交; 失败的 url 放回 pending, 下次还能再领, 次数用完的标记为 failed
+        提交失败时标记放回缓存, 下次再试
+        """
+        if not self._done and not self._failed:
+            return
+        done, failed = self._done, self._failed
+        self._done, self._failed = [], []
+        try:
+            await self._db(self._mark, done, failed)
+        except BaseException:
+            self._done[:0], self._failed[:0] = done, failed
+            raise
+
+    def _claim(self) -> List[str]:
+        now = time.time()
+        with self.conn:
+            urls = [r[0] for r in self.conn.execute(
+                "SELECT url FROM frontier WHERE state='pending' AND attempts < ? LIMIT ?",
+                (self.max_attempts, self.claim_batch))]
+            self.conn.executemany(
+                "UPDATE frontier SET state='inflight', attempts=attempts+1, updated_at=? WHERE url=?",
+                [(now, u) for u in urls])
+        return urls
+
+    async def claim(self, source: Optional[UrlSource] = None) -> AsyncIterator[str]:
+        """
+        按批领取 pending 的 url, 直到没有可领的为止
+        传入 source 时在后台把它 add 进表里, 同时开始领取; 暂时领空了就等下一块写入,
+        source 取完并且表里也领空才结束, 所以没有尽头的异步 url 来源也能边加边爬
+        """
+        adder = (asyncio.create_task(self.add(source, chunk=self.claim_batch))
+                 if source is not None else None)
+        try:
+            while True:
+                await self.flush()
+                self._added.clear()
+                batch = await self._db(self._claim)
+                if batch:
+                    for u in batch:
+                        yield u
+                    continue
+                if adder is None:
+                    break
+                if adder.done():
+                    # add 出错时抛出来; 结束前再领一轮, 最后一块可能是在这次领取之后才写入的
+                    adder.result()
+                    adder = None
+                    continue
+                waiter = asyncio.ensure_future(self._added.wait())
+                try:
+                    await asyncio.wait({adder, waiter}, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    waiter.cancel()
+            await self.flush()
+        finally:
+            if adder is not None and not adder.done():
+                adder.cancel()
+                await asyncio.gather(adder, return_exceptions=True)
+
+    def done(self, url: str) -> None:
+        self._done.append(url)
+
+    def done_many(self, urls: Iterable[str]) -> None:
+        self._done.extend(urls)
+
+    def fail(self, url: str) -> None:
+        self._failed.append(url)
+
+    async def stats(self) -> Dict[str, int]:
+        await self.flush()
+        return dict(await self._db(
+            lambda: self.conn.execute("SELECT state, COUNT(*) FROM frontier GROUP BY state").fetchall()))
+
 #################
 ## 爬虫数据处理 ##
 #################
 
 
 class Pipeline:
-    def __init__(self, fetcher: BaseFetcher, processor: BaseProcessor, db_path: str = "news.db"):
+    """
+    sink 为空时沿用原来的做法:全部结果留在内存,最后一次性写库
+    传入 SqliteSink 时进入流式模式,处理完一条就送进写队列
+    传入 HostScheduler 时按域名轮询派发, 并做每个域名的限速
+    传入 Frontier 时先把 urls 写进 frontier 表, 再从表里领取, 被打断后重新运行会接着爬
+    """
+    def __init__(self, fetcher: BaseFetcher, processor: BaseProcessor, db_path: str = "news.db",
+                 sink: Optional[SqliteSink] = None, scheduler: Optional[HostScheduler] = None,
+                 frontier: Optional[Frontier] = None):
         self.fetcher = fetcher
         self.processor = processor
         self.db_path = db_path
+        self.sink = sink
+        self.scheduler = scheduler
+        self.frontier = frontier
 
     @timed
-    async def run(self, urls: Iterable[str], concurrency: int = 10) -> None:
+    async def run(self, urls: UrlSource, concurrency: int = 10) -> None:
         """
         函数只操作不返回值
-        可以并发处理一组 urls,最多并发concurrency个任务
-
+        用 run_pool 起 concurrency 个常驻 worker 处理 urls
+        urls 可以是列表、生成器,也可以是异步迭代器(比如从消息队列里流式读取)
         """
-        # Semaphore 是并发限制器 
-        sem = asyncio.Semaphore(concurrency)
+        if self.sink is not None:
+            await self._run_streaming(urls, concurrency)
+            return
         # 结果储存格式
-        results: List[Dict[str, str]] = []
+        results: List[ResultRow] = []
 
-        async def worker(url: str):
-            async with sem:
-                #在并发限制下运行
-                p = await self.fetcher.fetch(url)
-                if p:
-                    log.info("Fetched %s [%s] - %s", p.url, p.status, p.title)
-                    results.append(self.processor.process(p))
+        async def emit(row: ResultRow):
+            results.append(row)
 
-        await asyncio.gather(*(worker(u) for u in urls))
+        await self._crawl(urls, concurrency, emit)
 
+        t0 = time.perf_counter()
         with sqlite_conn(self.db_path) as conn:
-            conn.executemany("""INSERT INTO results(url,title,status,top_words)
-              VALUES(:url,:title,:status,:top_words)
-              ON CONFLICT(url) DO UPDATE SET
-                title=excluded.title, status=excluded.status, top_words=excluded.top_words,
-                created_at=CURRENT_TIMESTAMP
-            """, results)
+            conn.executemany(UPSERT_SQL, results)
+        METRICS.observe("sqlite_write", time.perf_counter() - t0)
+        await self.fetcher.persisted([r.url for r in results])
+        if self.frontier is not None:
+            self.frontier.done_many(r.url for r in results)
+            await self.frontier.flush()
         log.info("Saved %d rows -> %s", len(results), self.db_path)
 
+    async def _run_streaming(self, urls: UrlSource, concurrency: int) -> None:
+        """
+        流式模式:结果不在内存里堆积,写协程边爬边落库,中途崩溃也只丢最后一个批次
+        """
+        fr = self.frontier
+
+        async def on_flush(urls: List[str]) -> None:
+            await self.fetcher.persisted(urls)
+            if fr is not None:
+                fr.done_many(urls)
+
+        self.sink.on_flush = on_flush
+        async with self.sink:
+            await self._crawl(urls, concurrency, self.sink.put)
+        if self.frontier is not None:
+            await self.frontier.flush()
+        log.info("Saved %s -> %s", self.sink.stats(), self.sink.path)
+
+    async def _crawl(self, urls: UrlSource, concurrency: int,
+                     emit: Callable[[ResultRow], Awaitable[None]]) -> None:
+        """
+        抓取 + 处理, 每条结果交给 emit 决定放内存还是进写队列
+        """
+        sched, fr = self.scheduler, self.frontier
+        claimed: Optional[AsyncIterator[str]] = None
+        if fr is not None:
+            await fr.recover()
+            # 种子一边写进 frontier 一边领取, 不用等整个 url 来源读完
+            urls = claimed = fr.claim(urls)
+
+        async def handle(url: str):
+            # emitted: 结果交给了 emit, 要等落库后才算完成, 由 run/_run_streaming 负责标记
+            ok = emitted = False
+            try:
+                p = await self.fetcher.fetch(url)
+                if p and p.unchanged:
+                    log.info("Unchanged %s [%s]", p.url, p.status)
+                elif p:
+                    log.info("Fetched %s [%s] - %s", p.url, p.status, p.title)
+                    t0 = time.perf_counter()
+                    row = await self.processor.aprocess(p)
+                    # 同步处理器这里就是 CPU 时间; PoolProcessor 还包含进程间通信和排队
+                    METRICS.observe("process", time.perf_counter() - t0)
+                    # 结果已经算完, 在等写队列的时候不再占着整页内容
+                    p.release()
+                    await emit(row)
+                    emitted = True
+                ok = True
+            finally:
+                if not ok:
+                    self.fetcher.discard(url)
+                if sched is not None:
+                    sched.done(url)
+                if fr is not None and not ok:
+                    fr.fail(url)
+                elif fr is not None and not emitted:
+                    fr.done(url)
+
+        try:
+            await run_pool(sched.dispatch(urls) if sched else urls, handle, concurrency)
+        finally:
+            if claimed is not None:
+                # 提前退出时停掉后台的 add
+                await claimed.aclose()
+            if fr is not None:
+                await fr.flush()
+
 # ---------- main ----------
 async def main():
     setup_logging()
@@ -273,10 +1425,26 @@ async def main():
         "https://www.wikipedia.org/",
     ]
     async with http_session("test") as s:
-        fetcher = HttpFetcher(s)
-        processor = WordStatProcessor(topk=6)
-        pipe = Pipeline(fetcher, processor)
-        await pipe.run(urls, concurrency=8)
+        # 分词交给进程池, 所以这里不用流式抓取(流式抓取在读的时候就分好词了)
+        fetcher = CachingFetcher(HttpFetcher(s), "news.db")
+        processor = PoolProcessor(WordStatProcessor(topk=6), workers=2)
+        sink = SqliteSink("news.db", batch_size=200, flush_interval=1.0)
+        sched = HostScheduler(per_host=2, rate=2.0)
+        frontier = Frontier("news.db", recrawl_after=24 * 3600)
+        pipe = Pipeline(fetcher, processor, sink=sink, scheduler=sched, frontier=frontier)
+        try:
+            await pipe.run(urls, concurrency=8)
+        finally:
+            log.info("fetch cache %s, frontier %s", fetcher.stats(), await frontier.stats())
+            log.info("metrics %s", METRICS.to_json())
+            METRICS.write_prometheus("crawler.prom")
+            fetcher.close()
+            processor.close()
+            await frontier.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if sys.argv[1:] == ["bench"]:
+        bench_wordstat()
+        bench_memory()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -1,21 +1,66 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import argparse #参数解析器,添加参数交互，命令行传递参数
+import bz2
 import csv
+import ctypes
+import ctypes.util
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import io
 import logging
+import json
+import math
+import mmap
+import multiprocessing
 import os
+import queue
 import re
+import select
 import sqlite3
-from concurrent.futures import ProcessPoolExecutor, as_completed #并行线程和进程
-from dataclasses import dataclass
+import struct
+import sys
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait #并行线程和进程
+from dataclasses import astuple, dataclass
+from itertools import islice
 from pathlib import Path
-from typing import Dict, Generator, Iterable, List, Tuple
+from typing import IO, BinaryIO, Dict, Generator, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import zstandard  # 可选依赖, 只有处理 .log.zst 时才需要
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow as pa  # 可选依赖, 只有 --parquet 时才需要
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
 
 # 创建一个叫log_etl的日志
 LOG = logging.getLogger("log_etl")
 # 正则表达
 LINE_RE = re.compile(r"^(?P<ts>\S+) \| (?P<level>\w+) \| (?P<msg>.*)$")
 
+# bytes 版本的 LINE_RE, 只取 level, 在整个文件(mmap)上一次 findall
+# 对纯 ASCII 的行, 它和 parse_line(line) 的结果完全一致:
+#   _WS 是 str.strip() 会去掉的 ASCII 空白, _NWS 是 \S 能匹配的 ASCII 字符
+#   msg 里至少要有一个非空白字符, 否则 strip 之后 "| " 的空格被去掉, parse_line 也匹配不上
+_WS = rb"[\t\x0b\x0c\r\x1c-\x1f ]"
+_NWS = rb"[\x00-\x08\x0e-\x1b\x21-\x7f]"
+FAST_LINE_RE = re.compile(rb"^" + _WS + rb"*" + _NWS + rb"+ \| (\w+) \| [^\n]*" + _NWS + _WS + rb"*$", re.M)
+NON_ASCII_RE = re.compile(rb"[\x80-\xff]")
+# 和文本模式(universal newlines, summarize_file 的读法)一样分行: \r\n、单独的 \r、\n 都是行尾
+NEWLINE_RE = re.compile(rb"\r\n|\r|\n")
+BARE_CR_RE = re.compile(rb"\r(?!\n)")
+
 # 创建一个叫Row的规范类
 @dataclass
 class Row:
@@ -42,7 +87,13 @@ def parse_line(line: str) -> Row:
 def read_lines(path: Path) -> Generator[str, None, None]:
     """
     返回一个生成器,里面没有返回值,只有yield值
+    压缩日志(.log.gz / .log.bz2 / .log.zst)边解压边读
     """
+    if codec_of(str(path)):
+        with io.TextIOWrapper(open_decompressed(str(path)), encoding="utf-8", errors="ignore") as f:
+            for ln in f:
+                yield ln
+        return
     with path.open("r", encoding="utf-8", errors="ignore") as f:
         for ln in f:
             yield ln
@@ -55,66 +106,1647 @@ def summarize_file(path: str) -> Dict[str, int]:
         counts[row.level] = counts.get(row.level, 0) + 1
     return counts
 
+def split_lines(data: bytes) -> List[bytes]:
+    """
+    按 NEWLINE_RE 切成行(不带行尾); data 以行尾结束时最后的空串不算一行
+    """
+    lines = NEWLINE_RE.split(data)
+    if lines[-1] == b"":
+        lines.pop()
+    return lines
+
+def plan_chunks(path: str, chunk_size: int, start: int = 0,
+                end: Optional[int] = None) -> List[Tuple[str, int, int]]:
+    """
+    把文件 [start, end) 按 chunk_size 字节切成若干段 (path, start, end), end 默认是文件末尾
+    每个切点往后挪到下一个换行符之后, 保证每一行只属于一个分段
+    """
+    size = os.path.getsize(path) if end is None else end
+    if size - start <= chunk_size:
+        return [(path, start, size)] if size > start else []
+    chunks: List[Tuple[str, int, int]] = []
+    with open(path, "rb") as f:
+        while start < size:
+            end = start + chunk_size
+            if end < size:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            end = min(end, size)
+            chunks.append((path, start, end))
+            start = end
+    return chunks
+
+def summarize_range(path: str, start: int, end: int) -> Dict[str, int]:
+    """
+    统计文件 [start, end) 字节范围内各 level 次数, start 必须在行首
+    压缩文件的 start/end 是压缩后的偏移, 交给 summarize_compressed
+    """
+    if codec_of(path):
+        return summarize_compressed(path, start, end)
+    counts: Dict[str, int] = {}
+    for ln in _range_lines(path, start, end):
+        row = parse_line(ln.decode("utf-8", errors="ignore"))
+        counts[row.level] = counts.get(row.level, 0) + 1
+    return counts
+
+def _range_lines(path: str, start: int, end: int) -> Generator[bytes, None, None]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        n = 0
+        while pos < end:
+            # end 可能紧跟在一个单独的 \r 后面, 不能读过头
+            ln = f.readline(end - pos)
+            if not ln:
+                break
+            pos += len(ln)
+            for piece in split_lines(ln) if b"\r" in ln else (ln,):
+                n += 1
+                if n % PROGRESS_LINES == 0:
+                    progress_tick(pos - start, n)
+                yield piece
+
+def _count_newlines(buf, start: int, end: int, block: int = 1 << 20) -> int:
+    return sum(buf[i:min(i + block, end)].count(b"\n") for i in range(start, end, block))
+
+def _count_gap(buf, start: int, end: int, counts: Dict[str, int]) -> None:
+    """
+    快速正则没匹配上的那些整行: 纯 ASCII 的行一定是 UNKNOWN,
+    含非 ASCII 字节的行(比如 ts 里有中文、msg 只有中文)交给 parse_line 判断
+    """
+    if start >= end:
+        return
+    lines = buf[start:end].split(b"\n")
+    if lines[-1] == b"":
+        lines.pop()
+    for ln in lines:
+        level = parse_line(ln.decode("utf-8", errors="ignore")).level if NON_ASCII_RE.search(ln) else "UNKNOWN"
+        counts[level] = counts.get(level, 0) + 1
+
+def summarize_range_fast(path: str, start: int, end: int) -> Dict[str, int]:
+    """
+    summarize_range 的快速版本, 结果完全一样(包括 UNKNOWN)
+    mmap 映射文件, 直接在字节上跑 FAST_LINE_RE, 不解码、不逐行创建 Row
+    没有非 ASCII 字节的分段: UNKNOWN = 总行数 - 匹配行数
+    有非 ASCII 字节的分段: 匹配行之间的空隙逐行检查
+    """
+    if codec_of(path):
+        return summarize_compressed(path, start, end, fast=True)
+    counts: Dict[str, int] = {}
+    if end <= start:
+        return counts
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        count_fast(mm, start, end, counts)
+    return counts
+
+def count_fast(buf, start: int, end: int, counts: Dict[str, int]) -> None:
+    """
+    在 buf[start:end] 上统计 level, 累加到 counts; start 必须在行首
+    FAST_LINE_RE 只认 \n; 有单独 \r 的分段(CR 换行的文件、\r 刷新的进度输出)逐行解析
+    start 紧跟在 \r 后面时(断点停在单独的 \r 之后) ^ 也匹配不上第一行, 同样逐行解析
+    """
+    if end <= start:
+        return
+    if (start > 0 and buf[start - 1] == 0x0D) or BARE_CR_RE.search(buf, start, end):
+        for ln in split_lines(buf[start:end]):
+            level = parse_line(ln.decode("utf-8", errors="ignore")).level
+            counts[level] = counts.get(level, 0) + 1
+        return
+    if not NON_ASCII_RE.search(buf, start, end):
+        matched = 0
+        for level in FAST_LINE_RE.findall(buf, start, end):
+            key = level.decode("ascii")
+            counts[key] = counts.get(key, 0) + 1
+            matched += 1
+        total = _count_newlines(buf, start, end) + (buf[end - 1] != 0x0A)
+        if total > matched:
+            counts["UNKNOWN"] = counts.get("UNKNOWN", 0) + total - matched
+        return
+    pos = start
+    for m in FAST_LINE_RE.finditer(buf, start, end):
+        _count_gap(buf, pos, m.start(), counts)
+        key = m.group(1).decode("ascii")
+        counts[key] = counts.get(key, 0) + 1
+        pos = m.end() + 1  # 跳过这一行末尾的换行符
+    _count_gap(buf, pos, end, counts)
+
+###################
+## 压缩日志的读取 ##
+###################
+
+# 按扩展名选择解压方式, 都是流式解压, 不落临时文件
+CODECS = {".gz": "gz", ".bz2": "bz2", ".zst": "zst"}
+LOG_SUFFIXES = (".log",) + tuple(".log" + ext for ext in CODECS)
+BLOCK_SIZE = 1 << 20
+
+def codec_of(path: str) -> Optional[str]:
+    return CODECS.get(os.path.splitext(path)[1])
+
+def open_decompressed(path: str) -> BinaryIO:
+    """
+    以二进制流的方式打开压缩日志, 读出来的是解压后的内容
+    """
+    codec = codec_of(path)
+    if codec == "gz":
+        return gzip.open(path, "rb")
+    if codec == "bz2":
+        return bz2.open(path, "rb")
+    if codec == "zst":
+        if zstandard is None:
+            raise RuntimeError(f"reading {path} requires the zstandard package (pip install zstandard)")
+        # read_across_frames: 多个 frame 拼接的文件(比如追加压缩)也能读完
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+    return open(path, "rb")
+
+def _find_gzip_member(f, pos: int, size: int, probe: int = 1 << 20) -> Optional[int]:
+    """
+    从 pos 往后最多找 probe 字节, 找一个 gzip member 的开头
+    先找魔数 1f 8b 08, 再试着解压一小段确认不是压缩数据里碰巧出现的字节
+    只有一个 member 的普通 gz 文件找不到切点, 整个文件交给一个进程
+    """
+    f.seek(pos)
+    window = f.read(min(probe, size - pos))
+    i = window.find(b"\x1f\x8b\x08")
+    while i >= 0:
+        if window[i + 3:i + 4] and window[i + 3] & 0xE0 == 0:
+            f.seek(pos + i)
+            d = zlib.decompressobj(31)
+            try:
+                if d.decompress(f.read(64 * 1024)):
+                    return pos + i
+            except zlib.error:
+                pass
+        i = window.find(b"\x1f\x8b\x08", i + 1)
+    return None
+
+def plan_gzip_chunks(path: str, chunk_size: int) -> List[Tuple[str, int, int]]:
+    """
+    多 member 的 gzip(比如 bgzip、或者多个 gz 直接 cat 在一起)可以从 member 开头独立解压,
+    按 chunk_size 找 member 边界切分, 多个进程并行解压
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        target = chunk_size
+        while target < size:
+            off = _find_gzip_member(f, target, size)
+            if off is None:
+                target += chunk_size
+                continue
+            bounds.append(off)
+            target = off + chunk_size
+    ends = bounds[1:] + [size]
+    return [(path, a, b) for a, b in zip(bounds, ends) if b > a]
+
+def _gzip_blocks(path: str, start: int) -> Generator[Tuple[bytes, int], None, None]:
+    """
+    从 start(某个 member 的开头)开始逐个 member 解压, yield (解压数据, 这段数据所在 member 的压缩起点)
+    """
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = member = start
+        d = zlib.decompressobj(31)
+        while True:
+            raw = f.read(BLOCK_SIZE)
+            if not raw:
+                if member < pos and not d.eof:
+                    raise EOFError(f"{path}: truncated gzip member at {member}")
+                return
+            pos += len(raw)
+            while raw:
+                out = d.decompress(raw)
+                if out:
+                    yield out, member
+                if not d.eof:
+                    break
+                raw = d.unused_data
+                member = pos - len(raw)
+                d = zlib.decompressobj(31)
+                if raw.strip(b"\x00") == b"" and f.peek(1) == b"":
+                    return  # 文件末尾的补零
+
+def _count_buf(buf: bytes, counts: Dict[str, int], fast: bool,
+               agg: Optional["Aggregate"] = None) -> None:
+    if fast and agg is None:
+        count_fast(buf, 0, len(buf), counts)
+        return
+    for ln in split_lines(buf):
+        row = parse_line(ln.decode("utf-8", errors="ignore"))
+        if agg is not None:
+            agg.add(row)
+        else:
+            counts[row.level] = counts.get(row.level, 0) + 1
+
+def summarize_compressed(path: str, start: int, end: int, fast: bool = False,
+                         agg: Optional["Aggregate"] = None) -> Dict[str, int]:
+    """
+    解压后统计, 解压在 worker 进程里流式进行
+    gzip 分段时, 切点在 member 边界而不是行边界, 所以按 "一行属于它前一个换行符所在的分段" 来划分:
+    start > 0 的分段跳过第一个换行符之前的内容; 每个分段读到 end 之后, 再往后读到第一个换行符为止
+    传入 agg 时每一行都交给 agg 做聚合(level 计数也在 agg.levels 里)
+    """
+    counts: Dict[str, int] = agg.levels if agg is not None else {}
+    if codec_of(path) == "gz" and (start > 0 or end < os.path.getsize(path)):
+        blocks = ((data, member >= end) for data, member in _gzip_blocks(path, start))
+    else:
+        blocks = _file_blocks(path)
+    skip_first = start > 0
+    carry = b""
+    for data, past_end in blocks:
+        if skip_first:
+            if past_end:
+                break
+            i = data.find(b"\n")
+            if i < 0:
+                continue
+            data, skip_first = data[i + 1:], False
+        if past_end:
+            i = data.find(b"\n")
+            if i < 0:
+                carry += data
+                continue
+            carry += data[:i + 1]
+            break
+        data = carry + data
+        j = data.rfind(b"\n")
+        if j < 0:
+            carry = data
+            continue
+        _count_buf(data[:j + 1], counts, fast, agg)
+        carry = data[j + 1:]
+    if carry:
+        _count_buf(carry, counts, fast, agg)
+    return counts
+
+def _file_blocks(path: str) -> Generator[Tuple[bytes, bool], None, None]:
+    with open_decompressed(path) as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                return
+            yield data, False
+
+###############
+## 流式聚合 ###
+###############
+
+# msg 里的 uuid、0x 开头或者较长的十六进制串、数字都换成 <*>, 剩下的就是消息模板
+ID_RE = re.compile(r"\b(?:[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}|0x[0-9a-fA-F]+|"
+                   r"(?=[0-9a-fA-F]*\d)[0-9a-fA-F]{8,})\b")
+NUM_RE = re.compile(r"\d+")
+# 每个文件最多保留这么多个模板的计数, 超出时只保留次数最多的一部分(近似 top-N)
+TEMPLATE_CAP = 1000
+
+def mask_message(msg: str) -> str:
+    return NUM_RE.sub("<*>", ID_RE.sub("<*>", msg))
+
+class HyperLogLog:
+    """
+    HyperLogLog 近似去重计数, 2**p 个寄存器(p=12 时 4KB, 误差约 1.6%)
+    两个 HLL 合并就是寄存器逐个取最大值, 所以各进程的结果可以直接合并, 也能存进数据库下次继续合并
+    """
+    __slots__ = ("p", "registers")
+
+    def __init__(self, p: int = 12, registers: Optional[bytes] = None):
+        self.p = p
+        self.registers = bytearray(registers) if registers else bytearray(1 << p)
+
+    def add(self, value: str) -> None:
+        x = int.from_bytes(hashlib.blake2b(value.encode("utf-8", "ignore"), digest_size=8).digest(), "big")
+        idx = x >> (64 - self.p)
+        rest = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self) -> int:
+        m = len(self.registers)
+        e = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if e <= 2.5 * m and zeros:
+            e = m * math.log(m / zeros)  # 基数小的时候用线性计数更准
+        return int(round(e))
+
+class Aggregate:
+    """
+    单次遍历里同时计算的可合并聚合结果:
+    levels: 各 level 次数; minutes: (分钟, level) 次数; templates: 消息模板次数; messages: 不同消息数(HLL)
+    各进程各算各的分段, 主进程用 merge 合并
+    """
+    def __init__(self):
+        self.levels: Dict[str, int] = {}
+        self.minutes: Counter = Counter()
+        self.templates: Counter = Counter()
+        self.messages = HyperLogLog()
+
+    def add(self, row: Row, n: int = 1) -> None:
+        """
+        n 为 -1 时撤销之前临时计入的一行; HLL 没法删除, 只在加的时候更新
+        """
+        self.levels[row.level] = self.levels.get(row.level, 0) + n
+        ts = row.ts
+        # 2025-01-01T00:00:00 这样的时间戳取到分钟, 其它格式归到 NA
+        minute = ts[:16] if len(ts) >= 16 and ts[10] == "T" else "NA"
+        self.minutes[(minute, row.level)] += n
+        self.templates[mask_message(row.msg)] += n
+        if len(self.templates) > 2 * TEMPLATE_CAP:
+            self._prune()
+        if n > 0:
+            self.messages.add(row.msg)
+
+    def _prune(self) -> None:
+        self.templates = Counter(dict(self.templates.most_common(TEMPLATE_CAP)))
+
+    def merge(self, other: "Aggregate") -> "Aggregate":
+        merge_counts(self.levels, other.levels)
+        self.minutes.update(other.minutes)
+        self.templates.update(other.templates)
+        if len(self.templates) > TEMPLATE_CAP:
+            self._prune()
+        self.messages.merge(other.messages)
+        return self
+
+def aggregate_range(path: str, start: int, end: int) -> Aggregate:
+    """
+    和 summarize_range 一样的分段, 但每一行都做完整的聚合
+    """
+    agg = Aggregate()
+    if codec_of(path):
+        summarize_compressed(path, start, end, agg=agg)
+        return agg
+    for ln in _range_lines(path, start, end):
+        agg.add(parse_line(ln.decode("utf-8", errors="ignore")))
+    return agg
+
+def bench_fast(files: List[str]) -> None:
+    """
+    对比 summarize_range 和 summarize_range_fast 的每秒行数, 并核对结果一致
+    """
+    for fp in files:
+        size = os.path.getsize(fp)
+        t0 = time.perf_counter()
+        slow = summarize_range(fp, 0, size)
+        t1 = time.perf_counter()
+        fast = summarize_range_fast(fp, 0, size)
+        t2 = time.perf_counter()
+        lines = sum(slow.values())
+        LOG.info("%s: %d lines, parse_line %.0f lines/s, fast %.0f lines/s (x%.1f), same=%s",
+                 fp, lines, lines / max(t1 - t0, 1e-9), lines / max(t2 - t1, 1e-9),
+                 (t1 - t0) / max(t2 - t1, 1e-9), slow == fast)
+
+def merge_counts(dst: Dict[str, int], src: Dict[str, int]) -> Dict[str, int]:
+    for level, cnt in src.items():
+        dst[level] = dst.get(level, 0) + cnt
+    return dst
+
+###############
+## 输出 sink ###
+###############
+
+# 每批写入的行数: 太小调用次数多, 太大占内存
+BATCH_ROWS = 50_000
+
+def batched(rows: Iterable[tuple], n: int) -> Generator[List[tuple], None, None]:
+    it = iter(rows)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+class Sink(ABC):
+    """
+    输出接口: write(table, columns, rows) 把任意长的行流按 BATCH_ROWS 分批交给 write_batch
+    同时统计写入的行数和耗时, 结束时 report 打到日志里
+    """
+    name = "sink"
+
+    def __init__(self):
+        self.rows = 0
+        self.seconds = 0.0
+
+    def write(self, table: str, columns: Sequence[str], rows: Iterable[tuple]) -> None:
+        for batch in batched(rows, BATCH_ROWS):
+            t0 = time.perf_counter()
+            self.write_batch(table, columns, batch)
+            self.seconds += time.perf_counter() - t0
+            self.rows += len(batch)
+
+    @abstractmethod
+    def write_batch(self, table: str, columns: Sequence[str], batch: List[tuple]) -> None:
+        ...
+
+    def close(self) -> None:
+        pass
+
+    def report(self) -> None:
+        LOG.info("%s sink: %d rows in %.3fs (%.0f rows/s)", self.name, self.rows, self.seconds,
+                 self.rows / self.seconds if self.seconds else 0)
+
+class CsvSink(Sink):
+    """
+    level_counts 写到 out, 其它表写到同目录下的 <out 文件名>_<表名>.csv
+    """
+    name = "csv"
+
+    def __init__(self, out: Path):
+        super().__init__()
+        self.out = out
+        self._files: Dict[str, IO[str]] = {}
+        self._writers = {}
+
+    def _writer(self, table: str, columns: Sequence[str]):
+        if table not in self._writers:
+            path = self.out if table == "level_counts" else self.out.with_name(
+                f"{self.out.stem}_{table}{self.out.suffix}")
+            f = path.open("w", newline="", encoding="utf-8")
+            w = csv.writer(f)
+            w.writerow(columns) # 表头
+            self._files[table], self._writers[table] = f, w
+        return self._writers[table]
+
+    def write_batch(self, table: str, columns: Sequence[str], batch: List[tuple]) -> None:
+        self._writer(table, columns).writerows(batch)
+
+    def close(self) -> None:
+        for f in self._files.values():
+            f.close()
+        self._files, self._writers = {}, {}
+
+class ParquetSink(Sink):
+    """
+    列式输出, 每个表一个 <表名>.parquet, 每批转成一个 Arrow RecordBatch 追加写入
+    需要 pyarrow(可选依赖)
+    """
+    name = "parquet"
+
+    def __init__(self, out_dir: Path):
+        super().__init__()
+        if pa is None:
+            raise RuntimeError("--parquet requires the pyarrow package (pip install pyarrow)")
+        self.out_dir = out_dir
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self._writers: Dict[str, "pq.ParquetWriter"] = {}
+
+    def write_batch(self, table: str, columns: Sequence[str], batch: List[tuple]) -> None:
+        rb = pa.RecordBatch.from_arrays([pa.array(col) for col in zip(*batch)], names=list(columns))
+        w = self._writers.get(table)
+        if w is None:
+            w = self._writers[table] = pq.ParquetWriter(str(self.out_dir / f"{table}.parquet"), rb.schema)
+        w.write_batch(rb)
+
+    def close(self) -> None:
+        for w in self._writers.values():
+            w.close()
+        self._writers = {}
+
+class SqliteSink(Sink):
+    """
+    批量写 SQLite: WAL、synchronous=NORMAL、内存临时表、大页缓存
+    写入是 "累加" 语义: 最后一列是计数, 其余列是主键, 冲突时把计数加上去
+    commit_every 为空时所有写入在一个事务里, 由调用方 commit; 否则每写这么多行提交一次
+    """
+    name = "sqlite"
+
+    def __init__(self, db: Path, commit_every: Optional[int] = None):
+        super().__init__()
+        self.commit_every = commit_every
+        self._uncommitted = 0
+        self.conn = sqlite3.connect(db)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA temp_store=MEMORY")
+        self.conn.execute("PRAGMA cache_size=-65536")  # 64MB
+
+    def write_batch(self, table: str, columns: Sequence[str], batch: List[tuple]) -> None:
+        keys, value = columns[:-1], columns[-1]
+        self.conn.executemany(
+            f"INSERT INTO {table}({','.join(columns)}) VALUES({','.join('?' * len(columns))}) "
+            f"ON CONFLICT({','.join(keys)}) DO UPDATE SET {value}={table}.{value}+excluded.{value}",
+            batch)
+        self._uncommitted += len(batch)
+        if self.commit_every is not None and self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self) -> None:
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self) -> None:
+        self.conn.close()
+
 def save_csv(rows: Iterable[Tuple[str, str, int]], out: Path) -> None:
-    with out.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["file", "level", "count"]) # 表头
-        for r in rows:
-            w.writerow(r)
+    sink = CsvSink(out)
+    try:
+        sink.write("level_counts", ("file", "level", "count"), rows)
+    finally:
+        sink.close()
+
+LEVEL_COUNTS_DDL = """CREATE TABLE IF NOT EXISTS level_counts(
+  file TEXT, level TEXT, count INTEGER,
+  PRIMARY KEY(file, level))"""
+
+CHECKPOINTS_DDL = """CREATE TABLE IF NOT EXISTS file_checkpoints(
+  file TEXT PRIMARY KEY, inode INTEGER, size INTEGER, mtime REAL,
+  offset INTEGER, head TEXT, tail TEXT)"""
+
+def ensure_checkpoints(conn: sqlite3.Connection) -> None:
+    """
+    建断点表; 老库里没有 tail 列时补上
+    """
+    conn.execute(CHECKPOINTS_DDL)
+    if "tail" not in {r[1] for r in conn.execute("PRAGMA table_info(file_checkpoints)")}:
+        conn.execute("ALTER TABLE file_checkpoints ADD COLUMN tail TEXT")
+
+AGGREGATE_DDL = (
+    """CREATE TABLE IF NOT EXISTS minute_counts(
+      file TEXT, minute TEXT, level TEXT, count INTEGER,
+      PRIMARY KEY(file, minute, level))""",
+    """CREATE TABLE IF NOT EXISTS message_templates(
+      file TEXT, template TEXT, count INTEGER,
+      PRIMARY KEY(file, template))""",
+    """CREATE TABLE IF NOT EXISTS distinct_messages(
+      file TEXT PRIMARY KEY, registers BLOB, estimate INTEGER)""",
+)
+
+def _save_aggregates(sink: SqliteSink, aggs: Dict[str, Aggregate]) -> None:
+    """
+    分钟计数和模板计数累加到已有值上, HLL 寄存器和库里已有的合并后再估算
+    """
+    conn = sink.conn
+    sink.write("minute_counts", ("file", "minute", "level", "count"),
+               ((fp, minute, level, n) for fp, agg in aggs.items()
+                for (minute, level), n in agg.minutes.items()))
+    sink.write("message_templates", ("file", "template", "count"),
+               ((fp, t, n) for fp, agg in aggs.items() for t, n in agg.templates.items()))
+    for fp, agg in aggs.items():
+        conn.execute("""DELETE FROM message_templates WHERE file=? AND template NOT IN (
+          SELECT template FROM message_templates WHERE file=? ORDER BY count DESC LIMIT ?)""",
+                     (fp, fp, TEMPLATE_CAP))
+        old = conn.execute("SELECT registers FROM distinct_messages WHERE file=?", (fp,)).fetchone()
+        hll = agg.messages if old is None else agg.messages.merge(HyperLogLog(registers=old[0]))
+        conn.execute("INSERT OR REPLACE INTO distinct_messages(file,registers,estimate) VALUES(?,?,?)",
+                     (fp, bytes(hll.registers), hll.estimate()))
+
+def save_sqlite(rows: Iterable[Tuple[str, str, int]], db: Path,
+                checkpoints: Iterable["Checkpoint"] = (), reset_files: Iterable[str] = (),
+                aggregates: Optional[Dict[str, Aggregate]] = None) -> "SqliteSink":
+    """
+    rows 是本次新增的计数, 累加到已有计数上(撤销临时计入的半行时是负数, 减到 0 的行删掉);
+    reset_files 里的文件先清空旧计数(被轮转/截断/全量重跑)
+    aggregates 是 --aggregate 模式下每个文件的分钟计数/模板/去重结果
+    计数和断点在同一个事务里提交, 中途失败不会出现重复累加; 行是分批流式写入的, 不会整体放进内存
+    返回已关闭的 sink, 调用方可以用 report() 打印写入速度
+    """
+    sink = SqliteSink(db)
+    conn = sink.conn
+    try:
+        conn.execute(LEVEL_COUNTS_DDL)
+        ensure_checkpoints(conn)
+        for ddl in AGGREGATE_DDL:
+            conn.execute(ddl)
+        ensure_rollups(conn)
+        for table in ("level_counts", "minute_counts", "message_templates", "distinct_messages"):
+            conn.executemany(f"DELETE FROM {table} WHERE file=?", [(f,) for f in reset_files])
+        sink.write("level_counts", ("file", "level", "count"), rows)
+        checkpoints = list(checkpoints)
+        conn.executemany("""INSERT OR REPLACE INTO file_checkpoints(file,inode,size,mtime,offset,head,tail)
+          VALUES(?,?,?,?,?,?,?)""", [astuple(cp) for cp in checkpoints])
+        if aggregates:
+            _save_aggregates(sink, aggregates)
+        for table in ("level_counts", "minute_counts", "message_templates"):
+            conn.executemany(f"DELETE FROM {table} WHERE file=? AND count <= 0", [(cp.file,) for cp in checkpoints])
+        sink.commit()
+    finally:
+        sink.close()
+    return sink
+
+def iter_table(db: Path, table: str, columns: Sequence[str]) -> Generator[tuple, None, None]:
+    """
+    按主键顺序流式读出整张表, 用来导出到 csv / parquet
+    """
+    conn = sqlite3.connect(db)
+    try:
+        yield from conn.execute(f"SELECT {','.join(columns)} FROM {table} ORDER BY {','.join(columns[:-1])}")
+    finally:
+        conn.close()
+
+# 导出到 csv / parquet 的表和列
+EXPORT_TABLES = {
+    "level_counts": ("file", "level", "count"),
+    "minute_counts": ("file", "minute", "level", "count"),
+}
+
+#############
+## 查询层 ###
+#############
+
+# 文件所在目录: 去掉最后一个 / 之后的部分, 没有目录时是 "."
+_DIR_SQL = "coalesce(nullif(rtrim(rtrim({0}.file, replace({0}.file, '/', '')), '/'), ''), '.')"
+# minute 是 2025-01-01T00:00 这样的格式, 前 13 个字符就是小时; NA 保持 NA
+_HOUR_SQL = "substr({0}.minute, 1, 13)"
+
+ROLLUP_DDL = (
+    """CREATE TABLE IF NOT EXISTS level_totals(
+      level TEXT PRIMARY KEY, count INTEGER)""",
+    """CREATE TABLE IF NOT EXISTS dir_level_counts(
+      dir TEXT, level TEXT, count INTEGER,
+      PRIMARY KEY(dir, level))""",
+    """CREATE TABLE IF NOT EXISTS dir_hour_counts(
+      dir TEXT, hour TEXT, level TEXT, count INTEGER,
+      PRIMARY KEY(dir, hour, level))""",
+    """CREATE TABLE IF NOT EXISTS hour_level_counts(
+      level TEXT, hour TEXT, count INTEGER,
+      PRIMARY KEY(level, hour))""",
+    # 某个 level 计数最多的文件 / 目录
+    "CREATE INDEX IF NOT EXISTS level_counts_by_level ON level_counts(level, count DESC)",
+    "CREATE INDEX IF NOT EXISTS dir_level_counts_by_level ON dir_level_counts(level, count DESC)",
+    # 某个 level 最近 N 小时按目录汇总: 只在索引上做范围扫描, 不回表
+    "CREATE INDEX IF NOT EXISTS dir_hour_counts_by_level ON dir_hour_counts(level, hour, dir, count)",
+)
 
-def save_sqlite(rows: Iterable[Tuple[str, str, int]], db: Path) -> None:
+def _rollup_triggers(base: str, rollups: Sequence[Tuple[str, Sequence[Tuple[str, str]]]]) -> List[str]:
+    """
+    给 base 表生成 INSERT / UPDATE / DELETE 三个触发器, 把计数的变化量同步到每个汇总表
+    rollups 是 [(汇总表, [(汇总列, 由 base 行算出这一列的 SQL 模板)])], 模板里的 {0} 是 new 或 old
+    计数减到 0 的汇总行直接删掉
+    """
+    triggers = []
+    for event, ref, delta in (("INSERT", "new", "new.count"),
+                              ("UPDATE OF count", "new", "new.count - old.count"),
+                              ("DELETE", "old", "-old.count")):
+        body = []
+        for table, cols in rollups:
+            names = ", ".join(c for c, _ in cols)
+            exprs = ", ".join(e.format(ref) for _, e in cols)
+            where = " AND ".join(f"{c} = {e.format(ref)}" for c, e in cols)
+            body.append(f"INSERT INTO {table}({names}, count) VALUES({exprs}, {delta}) "
+                        f"ON CONFLICT({names}) DO UPDATE SET count = count + excluded.count;")
+            if event == "DELETE":
+                body.append(f"DELETE FROM {table} WHERE {where} AND count <= 0;")
+        name = f"{base}_{event.split()[0].lower()}_rollup"
+        triggers.append(f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {base} BEGIN\n  "
+                        + "\n  ".join(body) + "\nEND")
+    return triggers
+
+ROLLUP_TRIGGERS = _rollup_triggers("level_counts", [
+    ("level_totals", [("level", "{0}.level")]),
+    ("dir_level_counts", [("dir", _DIR_SQL), ("level", "{0}.level")]),
+]) + _rollup_triggers("minute_counts", [
+    ("dir_hour_counts", [("dir", _DIR_SQL), ("hour", _HOUR_SQL), ("level", "{0}.level")]),
+    ("hour_level_counts", [("level", "{0}.level"), ("hour", _HOUR_SQL)]),
+])
+
+def ensure_rollups(conn: sqlite3.Connection) -> None:
+    """
+    建汇总表、索引和触发器; 之后 level_counts / minute_counts 的每次增删改都由触发器同步到汇总表
+    老库第一次升级时汇总表是空的, 用现有数据补一次
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type='trigger' AND name='level_counts_insert_rollup'").fetchone():
+        return
+    conn.execute(LEVEL_COUNTS_DDL)
+    conn.execute(AGGREGATE_DDL[0])
+    for ddl in ROLLUP_DDL:
+        conn.execute(ddl)
+    d, h = _DIR_SQL.format("b"), _HOUR_SQL.format("b")
+    conn.execute("INSERT INTO level_totals(level, count) SELECT level, SUM(count) FROM level_counts GROUP BY level")
+    conn.execute(f"INSERT INTO dir_level_counts(dir, level, count) "
+                 f"SELECT {d}, level, SUM(count) FROM level_counts b GROUP BY 1, 2")
+    conn.execute(f"INSERT INTO dir_hour_counts(dir, hour, level, count) "
+                 f"SELECT {d}, {h}, level, SUM(count) FROM minute_counts b GROUP BY 1, 2, 3")
+    conn.execute(f"INSERT INTO hour_level_counts(level, hour, count) "
+                 f"SELECT level, {h}, SUM(count) FROM minute_counts b GROUP BY 1, 2")
+    for trigger in ROLLUP_TRIGGERS:
+        conn.execute(trigger)
+
+# 看板用到的查询, SQL 固定、参数用 ?, sqlite3 的语句缓存按 SQL 文本命中, 同一个连接上反复查询不再重新编译
+# 按小时的表只有 --aggregate 跑过才有数据
+QUERIES = {
+    "totals": ("level, count", "SELECT level, count FROM level_totals ORDER BY count DESC"),
+    "dirs": ("dir, count", "SELECT dir, count FROM dir_level_counts WHERE level = :level "
+                           "ORDER BY count DESC LIMIT :limit"),
+    "files": ("file, count", "SELECT file, count FROM level_counts WHERE level = :level "
+                             "ORDER BY count DESC LIMIT :limit"),
+    "recent": ("dir, count", "SELECT dir, SUM(count) AS n FROM dir_hour_counts "
+                             "WHERE level = :level AND hour >= :since AND hour <> 'NA' "
+                             "GROUP BY dir ORDER BY n DESC LIMIT :limit"),
+    "timeline": ("hour, count", "SELECT hour, count FROM hour_level_counts "
+                                "WHERE level = :level AND hour >= :since AND hour <> 'NA' ORDER BY hour"),
+    "rate": ("dir, rate, count", "SELECT dir, 1.0 * SUM(CASE WHEN level = :level THEN count ELSE 0 END) / SUM(count) "
+                                 "AS rate, SUM(count) FROM dir_level_counts GROUP BY dir ORDER BY rate DESC LIMIT :limit"),
+}
+
+class LogQuery:
+    """
+    只读查询: 长期持有一个连接, 语句缓存在连接上; 看板进程里复用同一个对象
+    """
+
+    def __init__(self, db: Path, cached_statements: int = 256):
+        conn = sqlite3.connect(db)
+        try:
+            ensure_rollups(conn)
+            conn.commit()
+        finally:
+            conn.close()
+        self.conn = sqlite3.connect(f"{Path(db).resolve().as_uri()}?mode=ro", uri=True,
+                                    cached_statements=cached_statements, check_same_thread=False)
+        self.conn.execute("PRAGMA mmap_size=268435456")
+
+    def run(self, name: str, level: str = "ERROR", since: str = "", limit: int = 20) -> List[tuple]:
+        return self.conn.execute(QUERIES[name][1], {"level": level, "since": since, "limit": limit}).fetchall()
+
+    def explain(self, name: str) -> List[str]:
+        return [r[-1] for r in self.conn.execute("EXPLAIN QUERY PLAN " + QUERIES[name][1],
+                                                  {"level": "", "since": "", "limit": 0})]
+
+    def close(self) -> None:
+        self.conn.close()
+
+def query_main(argv: List[str]) -> None:
+    """
+    python 2nd_prac.py query <totals|dirs|files|recent|timeline|rate> [--level ERROR] [--hours 24] ...
+    """
+    ap = argparse.ArgumentParser(prog="2nd_prac.py query", description="Query ETL results.")
+    ap.add_argument("name", choices=sorted(QUERIES))
+    ap.add_argument("--db", type=Path, default=Path("logs.db"))
+    ap.add_argument("--level", type=str, default="ERROR")
+    ap.add_argument("--hours", type=float, default=24, help="recent / timeline 只看最近多少小时(按本地时间)")
+    ap.add_argument("--limit", type=int, default=20)
+    ap.add_argument("--json", action="store_true", help="每行输出一个 JSON 对象")
+    ap.add_argument("--explain", action="store_true", help="只打印查询计划")
+    ap.add_argument("--log-level", type=str, default="INFO")
+    args = ap.parse_args(argv)
+
+    setup_logging(args.log_level)
+    if not args.db.exists():
+        LOG.error("No database at %s", args.db)
+        return
+    q = LogQuery(args.db)
+    try:
+        if args.explain:
+            print("\n".join(q.explain(args.name)))
+            return
+        since = time.strftime("%Y-%m-%dT%H", time.localtime(time.time() - args.hours * 3600))
+        t0 = time.perf_counter()
+        rows = q.run(args.name, level=args.level, since=since, limit=args.limit)
+        ms = (time.perf_counter() - t0) * 1000
+    finally:
+        q.close()
+    cols = [c.strip() for c in QUERIES[args.name][0].split(",")]
+    for r in rows:
+        print(json.dumps(dict(zip(cols, r)), ensure_ascii=False) if args.json else "\t".join(map(str, r)))
+    LOG.info("%s: %d rows in %.2f ms", args.name, len(rows), ms)
+
+##################
+## 增量处理的断点 ##
+##################
+
+# 用文件开头这么多字节的哈希判断文件是不是被截断后重写了(copytruncate 轮转)
+HEAD_BYTES = 4096
+
+@dataclass
+class Checkpoint:
+    file: str
+    inode: int
+    size: int
+    mtime: float
+    offset: int  # 已经处理到的位置, 总是在行首
+    head: str
+    # offset 之后没有换行结尾的最后半行, 已经临时计入; 文件再增长时先减掉, 和补全后的整行一起重新统计
+    tail: Optional[str] = None
+
+def load_checkpoints(db: Path) -> Dict[str, Checkpoint]:
+    if not Path(db).exists():
+        return {}
     conn = sqlite3.connect(db)
     try:
-        conn.execute("""CREATE TABLE IF NOT EXISTS level_counts(
-          file TEXT, level TEXT, count INTEGER,
-          PRIMARY KEY(file, level))""")
-        conn.executemany("""INSERT INTO level_counts(file,level,count)
-          VALUES(?,?,?)
-          ON CONFLICT(file,level) DO UPDATE SET count=excluded.count
-        """, list(rows))
-        conn.commit()
+        ensure_checkpoints(conn)
+        return {r[0]: Checkpoint(*r) for r in conn.execute(
+            "SELECT file, inode, size, mtime, offset, head, tail FROM file_checkpoints")}
     finally:
         conn.close()
 
-def collect_files(root: Path) -> List[str]:
+def _head_hash(f, n: int) -> str:
+    f.seek(0)
+    return hashlib.sha1(f.read(min(n, HEAD_BYTES))).hexdigest()
+
+def _last_line_end(f, start: int, size: int, block: int = 64 * 1024) -> int:
+    """
+    [start, size) 里最后一个行尾(\n 或单独的 \r)之后的位置; 写到一半的最后一行留到下次再处理
+    文件最后一个字节是 \r 时不算, 后面可能接着写进 \n 组成 \r\n
+    """
+    pos = size
+    while pos > start:
+        lo = max(start, pos - block)
+        f.seek(lo)
+        data = f.read(pos - lo)
+        i = max(data.rfind(b"\n"), data.rfind(b"\r", 0, size - 1 - lo))
+        if i >= 0:
+            return lo + i + 1
+        pos = lo
+    return start
+
+class FilePlan(NamedTuple):
+    start: int
+    end: int
+    reset: bool
+    checkpoint: Checkpoint
+    add_tail: Optional[str] = None   # 这次临时计入的最后半行
+    drop_tail: Optional[str] = None  # 上次临时计入、这次要减掉的半行
+
+def plan_file(path: str, cp: Optional[Checkpoint], full: bool = False) -> Optional[FilePlan]:
     """
-    返回路径下所有以.log结尾的文件
+    根据断点决定这个文件要处理哪一段 [start, end) 和新断点; 没有新内容时返回 None
+    inode 变了(轮转成新文件)、文件变小、或者开头内容变了(截断后重写)都视为新文件, 从 0 开始并重置计数
+    end 总是停在最后一个换行符之后, 没有换行结尾的最后一行一般还在写, 先不算; 但 full(--full 全量重算)时,
+    或者文件从上次断点起大小和 mtime 都没变(不再增长)时, 把这半行作为 add_tail 临时计入并记在断点里
+    之后文件再增长, 会从这半行的开头重新读, 同时返回 drop_tail 让调用方先减掉临时计入的那次, 和 --full 的结果一致
+    只多了半行时返回空区间 start == end, 调用方只更新断点里的大小和 mtime, 下次没再增长就能算上这行
     """
-    return [str(p) for p in root.rglob("*.log")]
+    st = os.stat(path)
+    stable = cp is not None and cp.inode == st.st_ino and cp.size == st.st_size and cp.mtime == st.st_mtime
+    if stable and (cp.offset >= st.st_size or cp.tail is not None):
+        return None
+    if codec_of(path):
+        # 压缩文件没法只读新增部分, 有变化就整个重算
+        return FilePlan(0, st.st_size, True, Checkpoint(path, st.st_ino, st.st_size, st.st_mtime, st.st_size, ""))
+    with open(path, "rb") as f:
+        reset = not stable and (cp is None or cp.inode != st.st_ino or st.st_size < cp.offset
+                                or _head_hash(f, cp.offset) != cp.head)
+        start = 0 if reset else cp.offset
+        end = _last_line_end(f, start, st.st_size)
+        head = _head_hash(f, end)
+        tail = None
+        if end < st.st_size and (full or stable):
+            f.seek(end)
+            tail = f.read(st.st_size - end).decode("utf-8", errors="ignore")
+    drop = cp.tail if cp is not None and not reset else None
+    return FilePlan(start, end, reset, Checkpoint(path, st.st_ino, st.st_size, st.st_mtime, end, head, tail),
+                    tail, drop)
+
+def tail_delta(plan: FilePlan, aggregate: bool):
+    """
+    plan 里半行的计数变化: add_tail 记 +1, drop_tail 记 -1; 都没有时返回 None
+    aggregate 为 True 时返回 Aggregate, 否则返回 level -> 次数
+    """
+    if plan.add_tail is None and plan.drop_tail is None:
+        return None
+    agg = Aggregate()
+    for tail, n in ((plan.add_tail, 1), (plan.drop_tail, -1)):
+        if tail is not None:
+            # 没有 \n 的半行里也可能有单独的 \r 分出来的几行
+            for ln in split_lines(tail.encode("utf-8")) or [b""]:
+                agg.add(parse_line(ln.decode("utf-8")), n)
+    return agg if aggregate else agg.levels
+
+##############
+## 文件发现 ###
+##############
+
+class FileEntry(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+@dataclass
+class FileFilter:
+    """
+    include / exclude 是 glob, 同时对文件名和相对 root 的路径匹配; include 为空时取所有 LOG_SUFFIXES 结尾的文件
+    exclude 匹配到目录时整个目录不再往下走
+    max_age / min_age 单位是秒, 按 mtime 算
+    """
+    include: Sequence[str] = ()
+    exclude: Sequence[str] = ()
+    min_size: int = 0
+    max_size: Optional[int] = None
+    max_age: Optional[float] = None
+    min_age: Optional[float] = None
+
+    def _hit(self, patterns: Sequence[str], name: str, rel: str) -> bool:
+        return any(fnmatch.fnmatchcase(name, g) or fnmatch.fnmatchcase(rel, g) for g in patterns)
+
+    def skip_dir(self, name: str, rel: str) -> bool:
+        return self._hit(self.exclude, name, rel)
+
+    def match_name(self, name: str, rel: str) -> bool:
+        if self.include:
+            if not self._hit(self.include, name, rel):
+                return False
+        elif not name.endswith(LOG_SUFFIXES):
+            return False
+        return not self._hit(self.exclude, name, rel)
+
+    def match_stat(self, st: os.stat_result, now: float) -> bool:
+        if st.st_size < self.min_size or (self.max_size is not None and st.st_size > self.max_size):
+            return False
+        age = now - st.st_mtime
+        if self.max_age is not None and age > self.max_age:
+            return False
+        return self.min_age is None or age >= self.min_age
+
+def _scan_dir(root: str, path: str, flt: FileFilter, now: float) -> Tuple[List[FileEntry], List[str]]:
+    """
+    扫一层目录, 返回 (匹配的文件, 要继续往下走的子目录)
+    先按文件名过滤, 只有名字匹配的才 stat, 百万级小文件的目录里能省掉大部分系统调用
+    """
+    files: List[FileEntry] = []
+    dirs: List[str] = []
+    try:
+        with os.scandir(path) as it:
+            for e in it:
+                rel = os.path.relpath(e.path, root).replace(os.sep, "/")
+                try:
+                    if e.is_dir(follow_symlinks=False):
+                        if not flt.skip_dir(e.name, rel):
+                            dirs.append(e.path)
+                    elif flt.match_name(e.name, rel) and e.is_file():
+                        st = e.stat()
+                        if flt.match_stat(st, now):
+                            files.append(FileEntry(e.path, st.st_size, st.st_mtime))
+                except OSError as err:
+                    # 扫描过程中被删掉/轮转走的文件直接跳过
+                    LOG.debug("Skip %s: %r", e.path, err)
+    except OSError as err:
+        LOG.warning("Cannot scan %s: %r", path, err)
+    return files, dirs
+
+def walk_files(root: Path, flt: Optional[FileFilter] = None, threads: int = 16) -> Generator[FileEntry, None, None]:
+    """
+    多线程 os.scandir 遍历目录树, 每扫完一个目录就把找到的文件 yield 出去, 不用等整棵树扫完
+    扫目录主要是等 IO(网络盘尤其明显), 用线程就够了
+    """
+    flt = flt or FileFilter()
+    root_s, now = str(root), time.time()
+    if os.path.isfile(root_s):
+        st = os.stat(root_s)
+        yield FileEntry(root_s, st.st_size, st.st_mtime)
+        return
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="scandir") as tp:
+        running = {tp.submit(_scan_dir, root_s, root_s, flt, now)}
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for fut in done:
+                files, dirs = fut.result()
+                for d in dirs:
+                    running.add(tp.submit(_scan_dir, root_s, d, flt, now))
+                yield from files
+
+class LargestFirst:
+    """
+    后台线程跑 walk_files, 发现的文件放进按大小排序的堆里; 调度时总是先取目前已发现的最大文件
+    大文件先开始, 最后剩下的都是小文件, 尾部等待时间更短
+    """
+
+    def __init__(self, entries: Iterable[FileEntry]):
+        self._heap: List[Tuple[int, str, FileEntry]] = []
+        self._cond = threading.Condition()
+        self.finished = False
+        self.found = 0
+        self.error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, args=(entries,), name="discovery", daemon=True)
+        self._thread.start()
+
+    def _run(self, entries: Iterable[FileEntry]) -> None:
+        try:
+            for e in entries:
+                with self._cond:
+                    heapq.heappush(self._heap, (-e.size, e.path, e))
+                    self.found += 1
+                    self._cond.notify()
+        except BaseException as err:
+            self.error = err
+        finally:
+            with self._cond:
+                self.finished = True
+                self._cond.notify_all()
+
+    def take(self, n: int) -> List[FileEntry]:
+        with self._cond:
+            return [heapq.heappop(self._heap)[2] for _ in range(min(n, len(self._heap)))]
+
+    def wait(self, timeout: Optional[float] = None) -> None:
+        """
+        等到有新文件或者遍历结束
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._heap or self.finished, timeout)
+
+    def exhausted(self) -> bool:
+        with self._cond:
+            return self.finished and not self._heap
+
+def collect_files(root: Path, flt: Optional[FileFilter] = None) -> List[str]:
+    """
+    返回路径下所有以.log结尾的文件, 以及轮转压缩后的 .log.gz / .log.bz2 / .log.zst, 大文件在前
+    """
+    return [e.path for e in sorted(walk_files(root, flt), key=lambda e: -e.size)]
+
+##############
+## 进度遥测 ###
+##############
+
+# worker 每处理这么多行汇报一次进度, 判断 "该不该发" 只是一次取模, 不影响逐行解析的速度
+PROGRESS_LINES = 8192
+# 同一个任务两次汇报之间至少隔这么多秒
+PROGRESS_TICK = 0.5
+
+# 以下三个只在 worker 进程里有值: 进度队列, 当前任务, 当前任务上次汇报的时间
+_progress_q = None
+_progress_task: Optional[Tuple[str, int]] = None
+_progress_last = 0.0
+
+def init_progress(q) -> None:
+    """
+    进程池的 initializer, 把进度队列交给 worker
+    """
+    global _progress_q
+    _progress_q = q
+
+def progress_tick(nbytes: int, nlines: int) -> None:
+    """
+    当前任务已经处理了 nbytes 字节 / nlines 行(累计值), 节流后发给主进程; 没开进度时什么也不做
+    """
+    global _progress_last
+    if _progress_q is None or _progress_task is None:
+        return
+    now = time.monotonic()
+    if now - _progress_last >= PROGRESS_TICK:
+        _progress_last = now
+        _progress_q.put(("tick", os.getpid(), _progress_task, nbytes, nlines))
+
+def tracked(fn, path: str, start: int, end: int):
+    """
+    在 worker 里包一层任务: 开始和结束各发一条消息, 中间由 progress_tick 汇报
+    mmap 快速路径和压缩文件中间不汇报, 只在结束时按整段计入
+    结束消息带着这段的墙钟时间(perf_counter)和本进程的 CPU 时间(process_time), 两者差很多说明在等 I/O
+    """
+    global _progress_task, _progress_last
+    task = (path, start)
+    _progress_task, _progress_last = task, time.monotonic()
+    _progress_q.put(("start", os.getpid(), task, end - start, None))
+    t0, c0 = time.perf_counter(), time.process_time()
+    lines = 0
+    try:
+        res = fn(path, start, end)
+        lines = sum((res.levels if isinstance(res, Aggregate) else res).values())
+        return res
+    finally:
+        _progress_task = None
+        _progress_q.put(("end", os.getpid(), task, end - start,
+                         (lines, time.perf_counter() - t0, time.process_time() - c0)))
+
+@dataclass
+class _FileTiming:
+    bytes: int = 0
+    lines: int = 0
+    chunks: int = 0
+    worker: float = 0.0  # 各分段在 worker 里的墙钟时间之和
+    cpu: float = 0.0     # 各分段的 CPU 时间之和
+    first: float = 0.0
+    last: float = 0.0
+
+class Progress:
+    """
+    主进程里的进度汇总: 后台线程读 worker 发来的消息, 每 interval 秒输出一行 JSON
+    字段: 已处理字节/行数、总体 MB/s、每个 worker 的 MB/s、预计剩余时间(eta_s)、耗时最长的在途任务
+    结束时每个文件输出一行 {"event": "file", ...}, 包括字节数、行数、分段数、
+    worker_s(各分段在 worker 里花的时间之和, 按它从慢到快排序)、cpu_s(其中真正用在 CPU 上的时间)和墙钟时间
+    planned_bytes 随着文件发现不断增长, 遍历没结束时 eta 只是按已发现的量估算(scanning=true)
+    """
+
+    def __init__(self, q, interval: float, out: IO[str], slowest: int = 3):
+        self.q = q
+        self.interval = interval
+        self.out = out
+        self.slowest = slowest
+        self.t0 = time.monotonic()
+        self.planned_bytes = 0
+        self.scanning = True
+        self.done_bytes = 0
+        self.done_lines = 0
+        self.inflight: Dict[Tuple[str, int], Tuple[int, float, int, int, int]] = {}  # pid, 开始时间, 总字节, 已处理字节/行
+        self.workers: Dict[int, List[float]] = {}  # pid -> [完成字节, 忙碌秒数]
+        self.files: Dict[str, _FileTiming] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="progress", daemon=True)
+        self._thread.start()
+
+    def plan(self, nbytes: int) -> None:
+        with self._lock:
+            self.planned_bytes += nbytes
+
+    def _handle(self, msg) -> None:
+        kind, pid, task, nbytes, extra = msg
+        now = time.monotonic()
+        with self._lock:
+            if kind == "start":
+                self.inflight[task] = (pid, now, nbytes, 0, 0)
+                ft = self.files.setdefault(task[0], _FileTiming(first=now))
+                ft.first = min(ft.first, now)
+            elif kind == "tick":
+                if task in self.inflight:
+                    pid, started, total, _, _ = self.inflight[task]
+                    self.inflight[task] = (pid, started, total, nbytes, extra)
+            else:
+                lines, secs, cpu = extra
+                self.inflight.pop(task, None)
+                self.done_bytes += nbytes
+                self.done_lines += lines
+                w = self.workers.setdefault(pid, [0, 0.0])
+                w[0] += nbytes
+                w[1] += secs
+                ft = self.files.setdefault(task[0], _FileTiming(first=now - secs))
+                ft.bytes += nbytes
+                ft.lines += lines
+                ft.chunks += 1
+                ft.worker += secs
+                ft.cpu += cpu
+                ft.last = now
+
+    def _run(self) -> None:
+        next_emit = time.monotonic() + self.interval
+        while True:
+            try:
+                msg = self.q.get(timeout=max(0.0, next_emit - time.monotonic()))
+            except queue.Empty:
+                msg = ()
+            if msg is None:
+                return
+            if msg:
+                self._handle(msg)
+            if time.monotonic() >= next_emit:
+                self._emit(self.snapshot())
+                next_emit = time.monotonic() + self.interval
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self.t0
+            part_bytes = sum(t[3] for t in self.inflight.values())
+            part_lines = sum(t[4] for t in self.inflight.values())
+            done = self.done_bytes + part_bytes
+            rate = done / elapsed if elapsed > 0 else 0.0
+            remaining = max(0, self.planned_bytes - done)
+            # 每个 worker 的速度 = (已完成 + 在途已处理字节) / (已完成任务耗时 + 在途任务已运行时间)
+            workers: Dict[int, List[float]] = {pid: list(w) for pid, w in self.workers.items()}
+            for pid, started, _, nbytes, _ in self.inflight.values():
+                w = workers.setdefault(pid, [0, 0.0])
+                w[0] += nbytes
+                w[1] += now - started
+            worker_rate = {pid: w[0] / w[1] / 1e6 if w[1] else 0.0 for pid, w in workers.items()}
+            slow = sorted(self.inflight.items(), key=lambda kv: kv[1][1])[:self.slowest]
+            return {
+                "event": "progress",
+                "elapsed_s": round(elapsed, 2),
+                "scanning": self.scanning,
+                "bytes": done,
+                "planned_bytes": self.planned_bytes,
+                "lines": self.done_lines + part_lines,
+                "mb_s": round(rate / 1e6, 2),
+                "eta_s": round(remaining / rate, 1) if rate else None,
+                "worker_mb_s": {str(pid): round(v, 2) for pid, v in sorted(worker_rate.items())},
+                "inflight": len(self.inflight),
+                "slowest": [{"file": path, "start": start, "running_s": round(now - t[1], 2),
+                             "done_bytes": t[3], "bytes": t[2]} for (path, start), t in slow],
+            }
+
+    def _emit(self, rec: Dict[str, object]) -> None:
+        self.out.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        self.out.flush()
+
+    def close(self) -> None:
+        """
+        在进程池关闭之后调用: 那时 worker 都已退出, 队列里的消息都已送达
+        """
+        self.scanning = False
+        self.q.put(None)
+        self._thread.join()
+        self._emit(self.snapshot())
+        for path, ft in sorted(self.files.items(), key=lambda kv: -kv[1].worker):
+            self._emit({"event": "file", "file": path, "bytes": ft.bytes, "lines": ft.lines, "chunks": ft.chunks,
+                        "worker_s": round(ft.worker, 3), "cpu_s": round(ft.cpu, 3),
+                        "wall_s": round(ft.last - ft.first, 3),
+                        "mb_s": round(ft.bytes / ft.worker / 1e6, 2) if ft.worker else None})
+        elapsed = time.monotonic() - self.t0
+        for pid, (nbytes, busy) in sorted(self.workers.items()):
+            # 忙碌比例明显低于 1 说明 worker 在等任务(发现/切分太慢), 加 --workers 没用
+            LOG.info("worker %d: %.1f MB in %.2fs busy (%.0f%% of %.2fs wall, %.1f MB/s)",
+                     pid, nbytes / 1e6, busy, 100 * busy / elapsed if elapsed else 0, elapsed,
+                     nbytes / busy / 1e6 if busy else 0)
+
+def plan_input_chunks(path: str, chunk_size: int, start: int, end: int) -> List[Tuple[str, int, int]]:
+    """
+    普通文件按行边界切; gzip 按 member 边界切; bz2 / zst 不能随机定位, 整个文件一个任务
+    """
+    codec = codec_of(path)
+    if codec is None:
+        return plan_chunks(path, chunk_size, start, end)
+    if codec == "gz":
+        return plan_gzip_chunks(path, chunk_size)
+    return [(path, 0, end)]
+
+def run_batch(args: argparse.Namespace, flt: FileFilter) -> None:
+    """
+    一次批量处理: 遍历 --root, 只处理断点之后的新内容, 写库并导出
+    """
+    LOG.info("Scanning %s; using %d workers", args.root, args.workers)
+    summarize = summarize_range_fast if args.fast else summarize_range
+    if args.aggregate:
+        summarize = aggregate_range
+    aggs: Dict[str, Aggregate] = {}
+    chunk_size = args.chunk_mb * 1024 * 1024
+    # 只处理上次断点之后新追加的完整行
+    checkpoints = {} if args.full else load_checkpoints(args.db)
+    per_file: Dict[str, Dict[str, int]] = {}
+    new_cps: Dict[str, Checkpoint] = {}
+    reset_files: List[str] = []
+    pending: Dict[str, int] = {}
+    failed = set()
+    # 目录边扫边处理: 发现的文件进堆, 进程池有空位时取当前最大的文件提交
+    # 只让少量任务排队, 后发现的大文件还能插到前面
+    feed = LargestFirst(walk_files(args.root, flt, args.scan_threads))
+    max_inflight = args.workers * 2
+    progress: Optional[Progress] = None
+    pool_kw = {}
+    if args.progress > 0:
+        progress_q = multiprocessing.Queue()
+        out = args.progress_out.open("a", encoding="utf-8") if args.progress_out else sys.stderr
+        progress = Progress(progress_q, args.progress, out)
+        pool_kw = dict(initializer=init_progress, initargs=(progress_q,))
+    with ProcessPoolExecutor(max_workers=args.workers, **pool_kw) as ex:
+        # 大文件切成多个字节段, 每段一个任务, 单个大文件也能用上所有进程
+        futs = {}
+        while True:
+            for entry in feed.take(max_inflight - len(futs)):
+                fp = entry.path
+                try:
+                    plan = plan_file(fp, checkpoints.get(fp), full=args.full)
+                except OSError as e:
+                    LOG.warning("Skip %s: %r", fp, e)
+                    continue
+                if plan is None:
+                    continue
+                new_cps[fp] = plan.checkpoint
+                delta = tail_delta(plan, args.aggregate)
+                if not plan.reset and plan.end == plan.start and delta is None:
+                    continue
+                if plan.reset:
+                    reset_files.append(fp)
+                per_file[fp] = {}
+                if delta is not None:
+                    if args.aggregate:
+                        aggs.setdefault(fp, Aggregate()).merge(delta)
+                        delta = delta.levels
+                    merge_counts(per_file[fp], delta)
+                chunks = plan_input_chunks(fp, chunk_size, plan.start, plan.end)
+                pending[fp] = len(chunks)
+                for c in chunks:
+                    if progress is not None:
+                        progress.plan(c[2] - c[1])
+                        futs[ex.submit(tracked, summarize, *c)] = fp
+                    else:
+                        futs[ex.submit(summarize, *c)] = fp
+            if not futs:
+                if feed.exhausted():
+                    break
+                feed.wait()
+                continue
+            if progress is not None:
+                progress.scanning = not feed.finished
+            # 遍历还没结束时定期回来看看有没有新文件
+            done, _ = wait(futs, timeout=None if feed.finished else 0.05, return_when=FIRST_COMPLETED)
+            # 同一个文件的各段结果合并到一起
+            for fut in done:
+                fp = futs.pop(fut)
+                pending[fp] -= 1
+                try:
+                    res = fut.result()
+                    if args.aggregate:
+                        aggs.setdefault(fp, Aggregate()).merge(res)
+                        res = res.levels
+                    merge_counts(per_file.setdefault(fp, {}), res)
+                except Exception as e:
+                    failed.add(fp)
+                    LOG.exception("Failed on %s: %r", fp, e)
+                if pending[fp] == 0 and fp not in failed:
+                    LOG.debug("Done %s", fp)
+    if progress is not None:
+        progress.close()
+        if args.progress_out:
+            progress.out.close()
+    if feed.error is not None:
+        raise feed.error
+    if not feed.found:
+        LOG.warning("No log files (%s) under %s", ", ".join(LOG_SUFFIXES), args.root)
+        return
+
+    LOG.info("Found %d files: %d with new data, %d reset, %d unchanged",
+             feed.found, len(per_file), len(reset_files), feed.found - len(per_file))
+    # 任意一段失败的文件整体丢弃, 不写入不完整的计数, 断点也不前进
+    results: List[Tuple[str, str, int]] = [
+        (fp, level, cnt) for fp, counts in per_file.items() if fp not in failed
+        for level, cnt in counts.items()]
+
+    save_sqlite(results, args.db,
+                checkpoints=[cp for fp, cp in new_cps.items() if fp not in failed],
+                reset_files=[fp for fp in reset_files if fp not in failed],
+                aggregates={fp: a for fp, a in aggs.items() if fp not in failed}).report()
+    export_tables(args)
+
+def export_tables(args: argparse.Namespace) -> None:
+    """
+    导出的是累加之后的总数; --aggregate 时连同每分钟计数一起导出
+    """
+    exports: List[Sink] = [CsvSink(args.csv)]
+    if args.parquet is not None:
+        exports.append(ParquetSink(args.parquet))
+    tables = list(EXPORT_TABLES) if args.aggregate else ["level_counts"]
+    for sink in exports:
+        try:
+            for table in tables:
+                sink.write(table, EXPORT_TABLES[table], iter_table(args.db, table, EXPORT_TABLES[table]))
+        finally:
+            sink.close()
+        sink.report()
+    LOG.info("Wrote %s and %s", args.csv, args.db)
+
+###############
+## 持续跟踪 ###
+###############
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+class PollWatcher:
+    """
+    没有 inotify 时的退路: 每隔 interval 秒遍历一次目录, 返回大小或 mtime 变了的文件
+    """
+
+    def __init__(self, root: Path, flt: FileFilter, interval: float, threads: int = 16):
+        self.root = root
+        self.flt = flt
+        self.interval = interval
+        self.threads = threads
+        self._next = 0.0
+        self._seen: Dict[str, Tuple[int, float]] = {}
+
+    def poll(self, timeout: float) -> Optional[List[str]]:
+        wait_s = self._next - time.monotonic()
+        if wait_s > timeout:
+            time.sleep(timeout)
+            return []
+        time.sleep(max(0.0, wait_s))
+        self._next = time.monotonic() + self.interval
+        changed = []
+        seen: Dict[str, Tuple[int, float]] = {}
+        for e in walk_files(self.root, self.flt, self.threads):
+            seen[e.path] = (e.size, e.mtime)
+            if self._seen.get(e.path) != seen[e.path]:
+                changed.append(e.path)
+        self._seen = seen
+        return changed
+
+    def close(self) -> None:
+        pass
+
+class InotifyWatcher:
+    """
+    Linux inotify(通过 ctypes 调 libc, 不需要额外依赖), 每个目录一个 watch, 新建的子目录自动加上
+    poll 返回有写入/新建/移入的文件; 事件队列溢出时返回 None, 调用方需要全量检查一遍
+    目录太多超过 max_user_watches 时抛 OSError, 由调用方退回轮询
+    """
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, root: Path, flt: FileFilter, debounce: float = 0.2):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.root = str(root)
+        self.flt = flt
+        self.debounce = debounce
+        self._dirs: Dict[int, str] = {}
+        try:
+            self._watch_tree(self.root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _watch_tree(self, top: str) -> List[str]:
+        """
+        给 top 以及下面所有没被 exclude 的目录加 watch, 返回其中已经存在的日志文件
+        """
+        files = []
+        for d, subdirs, names in os.walk(top):
+            wd = self._add(self.fd, os.fsencode(d), self.MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, f"inotify_add_watch({d}): {os.strerror(err)}")
+            self._dirs[wd] = d
+            subdirs[:] = [s for s in subdirs if not self.flt.skip_dir(s, self._rel(os.path.join(d, s)))]
+            files.extend(os.path.join(d, n) for n in names if self.flt.match_name(n, self._rel(os.path.join(d, n))))
+        return files
+
+    def _rel(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def poll(self, timeout: float) -> Optional[List[str]]:
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        # 写得很频繁的文件会连续触发事件, 稍等一下合并成一批
+        time.sleep(self.debounce)
+        buf = b""
+        while True:
+            try:
+                data = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            buf += data
+        changed = set()
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _, n = _INOTIFY_EVENT.unpack_from(buf, pos)
+            name = os.fsdecode(buf[pos + _INOTIFY_EVENT.size:pos + _INOTIFY_EVENT.size + n].rstrip(b"\0"))
+            pos += _INOTIFY_EVENT.size + n
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            d = self._dirs.get(wd)
+            if d is None or not name:
+                continue
+            path = os.path.join(d, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not self.flt.skip_dir(name, self._rel(path)):
+                    try:
+                        changed.update(self._watch_tree(path))
+                    except OSError as e:
+                        LOG.warning("Cannot watch %s: %r", path, e)
+            elif self.flt.match_name(name, self._rel(path)):
+                changed.add(path)
+        return sorted(changed)
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def make_watcher(root: Path, flt: FileFilter, poll_interval: float, threads: int = 16):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, flt)
+        except (OSError, AttributeError) as e:
+            LOG.warning("inotify unavailable (%r); polling every %.1fs", e, poll_interval)
+    return PollWatcher(root, flt, poll_interval, threads)
+
+def follow(args: argparse.Namespace, flt: FileFilter) -> None:
+    """
+    持续跟踪 --root: 文件有新内容时只解析新追加的完整行(和批量模式同样的断点/轮转/截断处理)
+    计数先在内存里累加, 每 --flush-interval 秒用一个事务写入 level_counts 和断点
+    日志里输出这段时间的行数和每个 level 的占比; Ctrl-C 时先写入剩余计数再导出
+    这里只在主进程里解析, 新增内容一般很少, 不值得分发给进程池
+    """
+    summarize = summarize_range_fast if args.fast else summarize_range
+    if args.aggregate:
+        summarize = aggregate_range
+    cps = load_checkpoints(args.db)
+    watcher = make_watcher(args.root, flt, args.poll_interval, args.scan_threads)
+    LOG.info("Following %s with %s; flushing every %.1fs", args.root, type(watcher).__name__, args.flush_interval)
+    counts: Dict[str, Dict[str, int]] = {}
+    aggs: Dict[str, Aggregate] = {}
+    dirty: Dict[str, Checkpoint] = {}
+    resets = set()
+    window: Dict[str, int] = {}
+    totals: Dict[str, int] = {}
+
+    def flush() -> None:
+        if not dirty:
+            return
+        t0 = time.perf_counter()
+        save_sqlite([(fp, level, n) for fp, c in counts.items() for level, n in c.items()], args.db,
+                    checkpoints=list(dirty.values()), reset_files=sorted(resets), aggregates=aggs)
+        lines = sum(window.values())
+        merge_counts(totals, window)
+        LOG.info("flush: %d files, %d new lines in %.3fs; %s", len(dirty), lines, time.perf_counter() - t0,
+                 ", ".join(f"{lv} {n} ({100 * n / lines:.1f}%)" for lv, n in sorted(window.items()) if n)
+                 if lines > 0 else "-")
+        counts.clear()
+        aggs.clear()
+        dirty.clear()
+        resets.clear()
+        window.clear()
+
+    def ingest(fp: str) -> None:
+        try:
+            plan = plan_file(fp, cps.get(fp))
+            if plan is None:
+                return
+            res = summarize(fp, plan.start, plan.end) if plan.end > plan.start else None
+        except OSError as e:
+            # 读的时候文件被删掉/轮转走了, 下次有事件时再看
+            LOG.debug("Skip %s: %r", fp, e)
+            return
+        if plan.reset:
+            # 内存里还没写入的旧内容计数作废, 写库时先清掉这个文件的旧行
+            resets.add(fp)
+            counts.pop(fp, None)
+            aggs.pop(fp, None)
+        for r in (res, tail_delta(plan, args.aggregate)):
+            if r is None:
+                continue
+            if args.aggregate:
+                aggs.setdefault(fp, Aggregate()).merge(r)
+                r = r.levels
+            merge_counts(counts.setdefault(fp, {}), r)
+            merge_counts(window, r)
+        cps[fp] = dirty[fp] = plan.checkpoint
+
+    next_flush = time.monotonic() + args.flush_interval
+    try:
+        while True:
+            changed = watcher.poll(max(0.0, next_flush - time.monotonic()))
+            if changed is None:
+                # inotify 队列溢出, 丢了事件, 全量检查一遍(没变化的文件 plan_file 只做一次 stat)
+                LOG.warning("inotify queue overflow; rescanning %s", args.root)
+                changed = [e.path for e in walk_files(args.root, flt, args.scan_threads)]
+            for fp in changed:
+                ingest(fp)
+            if time.monotonic() >= next_flush:
+                # 最后一行没换行、一个 flush 周期内也没再增长的文件, 把这行也算上
+                for fp in [fp for fp, cp in cps.items() if cp.offset < cp.size and cp.tail is None]:
+                    ingest(fp)
+                flush()
+                next_flush = time.monotonic() + args.flush_interval
+    except KeyboardInterrupt:
+        LOG.info("Stopping follow")
+    finally:
+        watcher.close()
+        flush()
+    LOG.info("Followed totals: %s", ", ".join(f"{lv} {n}" for lv, n in sorted(totals.items())) or "-")
+    export_tables(args)
 
 def main():
     ap = argparse.ArgumentParser(description="ETL: parse logs and aggregate level counts.")
     ap.add_argument("--root", type=Path, default=Path("./logs"), help="log directory")
     ap.add_argument("--csv", type=Path, default=Path("level_counts.csv"))
     ap.add_argument("--db", type=Path, default=Path("logs.db"))
+    ap.add_argument("--parquet", type=Path, default=None, help="额外导出 parquet 的目录(需要 pyarrow)")
     ap.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    ap.add_argument("--chunk-mb", type=int, default=64, help="大文件按多少 MB 切分给多个进程")
+    ap.add_argument("--fast", action="store_true", help="mmap + bytes 正则统计 level, 不逐行解析")
+    ap.add_argument("--bench", action="store_true", help="只对比普通模式和 --fast 的速度")
+    ap.add_argument("--full", action="store_true", help="忽略断点, 所有文件从头重新统计")
+    ap.add_argument("--aggregate", action="store_true",
+                    help="同一次遍历里额外统计每分钟计数、消息模板、不同消息数(会忽略 --fast)")
+    ap.add_argument("--include", action="append", default=[], help="只处理匹配的文件(glob, 可多次), 默认 *.log*")
+    ap.add_argument("--exclude", action="append", default=[], help="跳过匹配的文件或目录(glob, 可多次)")
+    ap.add_argument("--min-size", type=int, default=0, help="跳过小于这么多字节的文件")
+    ap.add_argument("--max-size", type=int, default=None, help="跳过大于这么多字节的文件")
+    ap.add_argument("--max-age", type=float, default=None, help="只处理最近这么多小时内修改过的文件")
+    ap.add_argument("--min-age", type=float, default=None, help="跳过最近这么多小时内修改过的文件")
+    ap.add_argument("--scan-threads", type=int, default=16, help="遍历目录的线程数")
+    ap.add_argument("--progress", type=float, default=10.0, help="每隔多少秒输出一行 JSON 进度, 0 关闭")
+    ap.add_argument("--progress-out", type=Path, default=None, help="进度 JSON 写到这个文件, 默认 stderr")
+    ap.add_argument("--follow", action="store_true", help="处理完已有内容后继续监视 --root, 实时统计新追加的行")
+    ap.add_argument("--flush-interval", type=float, default=5.0, help="--follow 时每隔多少秒把计数写入数据库")
+    ap.add_argument("--poll-interval", type=float, default=2.0, help="没有 inotify 时轮询目录的间隔秒数")
     ap.add_argument("--log-level", type=str, default="INFO")
     args = ap.parse_args()
 
     setup_logging(args.log_level)
-    files = collect_files(args.root)
-    if not files:
-        LOG.warning("No .log files under %s", args.root)
+    flt = FileFilter(include=args.include, exclude=args.exclude, min_size=args.min_size, max_size=args.max_size,
+                     max_age=None if args.max_age is None else args.max_age * 3600,
+                     min_age=None if args.min_age is None else args.min_age * 3600)
+
+    if args.bench:
+        files = collect_files(args.root, flt)
+        if not files:
+            LOG.warning("No log files (%s) under %s", ", ".join(LOG_SUFFIXES), args.root)
+            return
+        bench_fast(files)
         return
 
-    LOG.info("Found %d files; using %d workers", len(files), args.workers)
-    results: List[Tuple[str, str, int]] = []
-    with ProcessPoolExecutor(max_workers=args.workers) as ex:
-        # 在进程池中，并行多个进程运行函数 summarize_file(fp)
-        futs = {ex.submit(summarize_file, fp): fp for fp in files}
-        # 这个结果需要使用 as_completed 来管理
-        for fut in as_completed(futs):
-            fp = futs[fut]
-            try:
-                counts = fut.result()
-                for level, cnt in counts.items():
-                    results.append((fp, level, cnt))
-            except Exception as e:
-                LOG.exception("Failed on %s: %r", fp, e)
-
-    save_csv(results, args.csv)
-    save_sqlite(results, args.db)
-    LOG.info("Wrote %s and %s", args.csv, args.db)
+    run_batch(args, flt)
+    if args.follow:
+        follow(args, flt)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:2] == ["query"]:
+        query_main(sys.argv[2:])
+    else:
+        main()
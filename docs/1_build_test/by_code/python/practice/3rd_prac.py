@@ -3,13 +3,26 @@
 import asyncio
 import json
 import logging
+import os
+import sqlite3
+import threading
 import time
-from functools import lru_cache #结果缓存装饰器
-from typing import Optional
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache, wraps #结果缓存装饰器
+from typing import Annotated, AsyncIterator, Awaitable, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
 
 import httpx
-from fastapi import Depends, FastAPI, HTTPException, Query
-from pydantic import BaseModel # fastapi需要来定义数据结构
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field # fastapi需要来定义数据结构
+
+try:
+    import redis.asyncio as aioredis  # 可选依赖, 只有 MINIAPI_L2=redis://... 时才需要
+except ImportError:
+    aioredis = None
 
 ###################
 ###  logging 模块 ##
@@ -21,8 +34,11 @@ logging.basicConfig(level=logging.INFO,
 # 定义叫api的logger
 log = logging.getLogger("api")
 
+T = TypeVar("T")
+
 # 定义一个修饰器函数
 def timed(fn):
+    @wraps(fn)  # 保留原函数签名, FastAPI 靠它解析查询参数和 Depends
     async def _inner(*a, **kw):
         """
         测试函数运行时间
@@ -41,15 +57,93 @@ class FetchResult(BaseModel):
     status: int
     title: str
 
+# 一次批量请求最多多少个 URL, 以及同时向上游发出的请求数上限
+BATCH_MAX_URLS = int(os.getenv("MINIAPI_BATCH_MAX_URLS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("MINIAPI_BATCH_CONCURRENCY", "20"))
+
+class BatchRequest(BaseModel):
+    urls: List[Annotated[str, Field(min_length=5)]] = Field(..., min_length=1, max_length=BATCH_MAX_URLS)
+    concurrency: Optional[int] = Field(None, ge=1, description="不超过 BATCH_CONCURRENCY")
+
 #################
 ## 异步建立会话 ###
 #################
-async def get_client() -> httpx.AsyncClient:
+
+def _env_host_limits(raw: str) -> Dict[str, int]:
+    """
+    "api.a.com=20,b.com=5" -> {"api.a.com": 20, "b.com": 5}
+    """
+    out = {}
+    for part in filter(None, (p.strip() for p in raw.split(","))):
+        host, _, n = part.partition("=")
+        out[host.strip()] = int(n)
+    return out
+
+@dataclass
+class ClientConfig:
     """
-    返回一个 httpx.AsyncClient的对象,本质是建立会话,与aiohttp类似
+    上游连接池配置, 默认值可以用环境变量覆盖(方便 uvicorn 启动时调整)
+    host_limits: 单独限制某些 host 的连接数, 每个 host 一个独立的连接池, 不和其它 host 抢
     """
-    async with httpx.AsyncClient(headers={"User-Agent": "MiniAPI/1.0"}, timeout=8.0) as c:
-        yield c
+    max_connections: int = int(os.getenv("MINIAPI_MAX_CONNECTIONS", "100"))
+    max_keepalive: int = int(os.getenv("MINIAPI_MAX_KEEPALIVE", "20"))
+    keepalive_expiry: float = float(os.getenv("MINIAPI_KEEPALIVE_EXPIRY", "30"))
+    timeout: float = float(os.getenv("MINIAPI_TIMEOUT", "8.0"))
+    http2: bool = os.getenv("MINIAPI_HTTP2", "0") == "1"
+    host_limits: Dict[str, int] = field(default_factory=lambda: _env_host_limits(os.getenv("MINIAPI_HOST_LIMITS", "")))
+
+CLIENT_CONFIG = ClientConfig()
+
+def build_client(cfg: ClientConfig) -> httpx.AsyncClient:
+    """
+    整个进程共用一个 AsyncClient, keep-alive 连接在请求之间复用, 重复访问同一个 host 不用再握手
+    http2 需要 h2 包, 没装时退回 HTTP/1.1
+    """
+    http2 = cfg.http2
+    if http2:
+        try:
+            import h2  # noqa: F401  可选依赖
+        except ImportError:
+            log.warning("http2 requested but h2 is not installed; using HTTP/1.1")
+            http2 = False
+    limits = httpx.Limits(max_connections=cfg.max_connections,
+                          max_keepalive_connections=cfg.max_keepalive,
+                          keepalive_expiry=cfg.keepalive_expiry)
+    mounts = {
+        f"all://{host}": httpx.AsyncHTTPTransport(
+            http2=http2, limits=httpx.Limits(max_connections=n, max_keepalive_connections=n,
+                                             keepalive_expiry=cfg.keepalive_expiry))
+        for host, n in cfg.host_limits.items()
+    }
+    return httpx.AsyncClient(headers={"User-Agent": "MiniAPI/1.0"}, timeout=cfg.timeout,
+                             limits=limits, http2=http2, mounts=mounts)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    启动时建连接池, 关闭时释放
+    """
+    global _l2
+    app.state.client = build_client(CLIENT_CONFIG)
+    _l2 = make_l2(L2_URL)
+    if _l2 is not None:
+        t0 = time.perf_counter()
+        n = await warm_up(_l2, CACHE_CONFIG.max_entries)
+        log.info(json.dumps({"event": "cache_warm_up", "backend": _l2.name, "entries": n,
+                             "ms": round((time.perf_counter() - t0) * 1000, 2)}))
+    try:
+        yield
+    finally:
+        await app.state.client.aclose()
+        if _l2 is not None:
+            await _l2.close()
+            _l2 = None
+
+async def get_client(request: Request) -> httpx.AsyncClient:
+    """
+    返回 lifespan 里创建的共享 httpx.AsyncClient, 测试时可以用 app.dependency_overrides 换掉
+    """
+    return request.app.state.client
 
 # 提取标题
 def extract_title(html: str) -> str:
@@ -57,10 +151,375 @@ def extract_title(html: str) -> str:
     m = re.search(r"<title[^>]*>(.*?)</title>", html, flags=re.I | re.S)
     return re.sub(r"\s+", " ", m.group(1)).strip() if m else "N/A"
 
-# simple in-memory async lock for cache stampede protection
-_cache = {}
-#定义一个协程锁，使多协程访问同一资源时，只有一个协程在处理，其他协程 等待
-_lock = asyncio.Lock()
+###############
+## 响应缓存 ###
+###############
+
+@dataclass
+class CacheConfig:
+    """
+    max_entries / max_bytes 任一超出就按 LRU 淘汰
+    上游没给 Cache-Control 时用 default_ttl; 给了也不超过 max_ttl
+    过期后 stale_while_revalidate 秒内仍先返回旧值, 同时在后台刷新(上游的 stale-while-revalidate 优先)
+    """
+    max_entries: int = int(os.getenv("MINIAPI_CACHE_ENTRIES", "10000"))
+    max_bytes: int = int(os.getenv("MINIAPI_CACHE_BYTES", str(64 * 1024 * 1024)))
+    default_ttl: float = float(os.getenv("MINIAPI_CACHE_TTL", "300"))
+    max_ttl: float = float(os.getenv("MINIAPI_CACHE_MAX_TTL", "86400"))
+    stale_while_revalidate: float = float(os.getenv("MINIAPI_CACHE_SWR", "60"))
+
+CACHE_CONFIG = CacheConfig()
+
+# 每个条目除了字符串本身以外的大致开销(对象头、OrderedDict 节点等)
+ENTRY_OVERHEAD = 200
+
+def cache_policy(headers: httpx.Headers, status: int, cfg: CacheConfig) -> Optional[Tuple[float, float]]:
+    """
+    按上游的 Cache-Control 算 (ttl, stale_while_revalidate), 不能缓存时返回 None
+    本服务对所有客户端共享, 所以 private 也不缓存, s-maxage 优先于 max-age; 5xx 不缓存
+    """
+    if status >= 500:
+        return None
+    directives: Dict[str, Optional[str]] = {}
+    for part in headers.get("cache-control", "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = value.strip('" ') or None
+    if {"no-store", "no-cache", "private"} & directives.keys():
+        return None
+
+    def seconds(name: str) -> Optional[float]:
+        try:
+            return float(directives[name]) if directives.get(name) is not None else None
+        except ValueError:
+            return None
+
+    ttl = seconds("s-maxage")
+    if ttl is None:
+        ttl = seconds("max-age")
+    if ttl is None:
+        ttl = cfg.default_ttl
+    if ttl <= 0:
+        return None
+    swr = seconds("stale-while-revalidate")
+    return min(ttl, cfg.max_ttl), cfg.stale_while_revalidate if swr is None else swr
+
+@dataclass(slots=True)
+class _Entry:
+    value: FetchResult
+    size: int
+    fresh_until: float
+    stale_until: float
+
+class ResponseCache:
+    """
+    TTL + LRU 缓存, 按条目数和字节数限制大小
+    所有方法都是同步的, 中间没有 await, 在事件循环里天然是原子的, 读写都不用加锁
+    get 返回 (值, 是否已过期): 过期但还在 stale 窗口里时返回旧值和 True, 由调用方安排后台刷新
+    """
+
+    def __init__(self, cfg: CacheConfig):
+        self.cfg = cfg
+        self._data: "OrderedDict[str, _Entry]" = OrderedDict()
+        self.bytes = 0
+        self.hits = self.stale_hits = self.misses = 0
+        self.evictions = self.expirations = self.rejected = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: str) -> bool:
+        e = self._data.get(key)
+        return e is not None and time.monotonic() < e.stale_until
+
+    def get(self, key: str) -> Tuple[Optional[FetchResult], bool]:
+        e = self._data.get(key)
+        if e is None:
+            self.misses += 1
+            return None, False
+        now = time.monotonic()
+        if now >= e.stale_until:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None, False
+        self._data.move_to_end(key)
+        if now < e.fresh_until:
+            self.hits += 1
+            return e.value, False
+        self.stale_hits += 1
+        return e.value, True
+
+    def set(self, key: str, value: FetchResult, ttl: float, swr: float = 0.0) -> None:
+        size = len(key) + len(value.url) + len(value.title.encode("utf-8")) + ENTRY_OVERHEAD
+        if size > self.cfg.max_bytes:
+            self.rejected += 1
+            return
+        if key in self._data:
+            self._remove(key)
+        now = time.monotonic()
+        self._data[key] = _Entry(value, size, now + ttl, now + ttl + swr)
+        self.bytes += size
+        while len(self._data) > self.cfg.max_entries or self.bytes > self.cfg.max_bytes:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        self.bytes -= self._data.pop(key).size
+
+    def clear(self) -> None:
+        self._data.clear()
+        self.bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._data), "bytes": self.bytes,
+            "max_entries": self.cfg.max_entries, "max_bytes": self.cfg.max_bytes,
+            "hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions, "expirations": self.expirations, "rejected": self.rejected,
+        }
+
+_cache = ResponseCache(CACHE_CONFIG)
+
+#####################
+## 二级(持久)缓存 ###
+#####################
+
+# "" 关闭; sqlite:///var/cache/miniapi.db 或 redis://localhost:6379/0
+L2_URL = os.getenv("MINIAPI_L2", "")
+
+class L2Cache(ABC):
+    """
+    进程内缓存之后的第二级: 重启后还在, 多个 uvicorn worker 共享
+    值是 JSON: FetchResult 加上按墙钟时间(time.time)算的 fresh_until / stale_until, 不同进程之间也能比较
+    读写失败只计数并记日志, 不影响请求, 相当于一次未命中; 解不出来的旧值(比如 FetchResult 字段改过)也一样
+    """
+    name = "l2"
+
+    def __init__(self):
+        self.hits = self.misses = self.writes = self.errors = 0
+
+    async def get(self, key: str) -> Optional[Tuple[FetchResult, float, float]]:
+        try:
+            raw = await self._get(key)
+            entry = self._decode(raw) if raw is not None else None
+        except Exception as e:
+            self._error("get", e)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    async def set(self, key: str, value: FetchResult, ttl: float, swr: float) -> None:
+        now = time.time()
+        raw = json.dumps({"value": value.model_dump(), "fresh_until": now + ttl, "stale_until": now + ttl + swr},
+                         ensure_ascii=False)
+        try:
+            await self._set(key, raw, now + ttl + swr)
+            self.writes += 1
+        except Exception as e:
+            self._error("set", e)
+
+    async def warm(self, limit: int) -> List[Tuple[str, FetchResult, float, float]]:
+        """
+        最近写入的、还没过 stale 期限的至多 limit 条, 新的在前
+        """
+        try:
+            rows = await self._recent(limit)
+        except Exception as e:
+            self._error("warm", e)
+            return []
+        out = []
+        for key, raw in rows:
+            try:
+                entry = self._decode(raw)
+            except Exception as e:
+                self._error("warm", e)
+                continue
+            if entry is not None:
+                out.append((key, *entry))
+        return out
+
+    def _decode(self, raw: str) -> Optional[Tuple[FetchResult, float, float]]:
+        doc = json.loads(raw)
+        if doc["stale_until"] <= time.time():
+            return None
+        return FetchResult(**doc["value"]), doc["fresh_until"], doc["stale_until"]
+
+    def _error(self, op: str, e: Exception) -> None:
+        self.errors += 1
+        log.warning(json.dumps({"event": "l2_error", "backend": self.name, "op": op, "error": repr(e)}))
+
+    def stats(self) -> Dict[str, object]:
+        return {"backend": self.name, "hits": self.hits, "misses": self.misses,
+                "writes": self.writes, "errors": self.errors}
+
+    @abstractmethod
+    async def _get(self, key: str) -> Optional[str]:
+        ...
+
+    @abstractmethod
+    async def _set(self, key: str, raw: str, expires_at: float) -> None:
+        ...
+
+    @abstractmethod
+    async def _recent(self, limit: int) -> List[Tuple[str, str]]:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+class SqliteL2(L2Cache):
+    """
+    本机多个 worker 共用一个 SQLite 文件(WAL: 读不阻塞写); 查询放到线程里做, 不阻塞事件循环
+    每写 PURGE_EVERY 次顺手删掉过期的行
+    """
+    name = "sqlite"
+    PURGE_EVERY = 1000
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")  # 其它 worker 正在写时等一会儿
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS l2_cache(
+          key TEXT PRIMARY KEY, value TEXT, stale_until REAL, stored_at REAL)""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS l2_cache_stored ON l2_cache(stored_at)")
+        self._db_lock = threading.Lock()
+
+    def _run(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._db_lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    async def _get(self, key: str) -> Optional[str]:
+        rows = await asyncio.to_thread(self._run, "SELECT value FROM l2_cache WHERE key=?", (key,))
+        return rows[0][0] if rows else None
+
+    async def _set(self, key: str, raw: str, expires_at: float) -> None:
+        await asyncio.to_thread(self._run, "INSERT OR REPLACE INTO l2_cache(key, value, stale_until, stored_at) "
+                                           "VALUES(?, ?, ?, ?)", (key, raw, expires_at, time.time()))
+        if self.writes % self.PURGE_EVERY == self.PURGE_EVERY - 1:
+            await asyncio.to_thread(self._run, "DELETE FROM l2_cache WHERE stale_until < ?", (time.time(),))
+
+    async def _recent(self, limit: int) -> List[Tuple[str, str]]:
+        return await asyncio.to_thread(
+            self._run, "SELECT key, value FROM l2_cache WHERE stale_until > ? ORDER BY stored_at DESC LIMIT ?",
+            (time.time(), limit))
+
+    async def close(self) -> None:
+        self.conn.close()
+
+class RedisL2(L2Cache):
+    """
+    Redis(或兼容协议的服务)后端, 跨机器共享; 条目带 PX 过期, 另用一个有序集合记录写入时间供预热
+    client 可以传入 fakeredis.aioredis.FakeRedis 之类的替身, 不需要真的 Redis 就能测
+    """
+    name = "redis"
+
+    def __init__(self, url: str = "", client=None, prefix: str = "miniapi:", max_recent: int = 100_000):
+        super().__init__()
+        if client is None:
+            if aioredis is None:
+                raise RuntimeError("redis L2 cache requires the redis package (pip install redis)")
+            client = aioredis.Redis.from_url(url, decode_responses=True)
+        self.r = client
+        self.prefix = prefix
+        self.recent_key = prefix + "recent"
+        self.max_recent = max_recent
+
+    async def _get(self, key: str) -> Optional[str]:
+        return await self.r.get(self.prefix + key)
+
+    async def _set(self, key: str, raw: str, expires_at: float) -> None:
+        now = time.time()
+        pipe = self.r.pipeline(transaction=False)
+        pipe.set(self.prefix + key, raw, px=max(1, int((expires_at - now) * 1000)))
+        pipe.zadd(self.recent_key, {key: now})
+        pipe.zremrangebyrank(self.recent_key, 0, -self.max_recent - 1)
+        await pipe.execute()
+
+    async def _recent(self, limit: int) -> List[Tuple[str, str]]:
+        keys = await self.r.zrevrange(self.recent_key, 0, limit - 1)
+        if not keys:
+            return []
+        values = await self.r.mget([self.prefix + k for k in keys])
+        return [(k, v) for k, v in zip(keys, values) if v is not None]
+
+    async def close(self) -> None:
+        await self.r.aclose()
+
+def make_l2(url: str) -> Optional[L2Cache]:
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisL2(url)
+    if url.startswith("sqlite:///"):
+        return SqliteL2(url[len("sqlite:///"):])
+    raise ValueError(f"unsupported MINIAPI_L2: {url!r}")
+
+_l2: Optional[L2Cache] = None
+
+def _promote(key: str, value: FetchResult, fresh_until: float, stale_until: float) -> bool:
+    """
+    L2 的条目放进 L1, 剩余的新鲜期和 stale 期照搬; 返回是否已经过了新鲜期
+    """
+    now = time.time()
+    _cache.set(key, value, max(0.0, fresh_until - now), stale_until - max(now, fresh_until))
+    return fresh_until <= now
+
+async def warm_up(l2: L2Cache, limit: int) -> int:
+    """
+    启动时把 L2 里最近写入的条目装进 L1, 旧的先放, 保持 LRU 顺序
+    """
+    entries = await l2.warm(limit)
+    for key, value, fresh_until, stale_until in reversed(entries):
+        _promote(key, value, fresh_until, stale_until)
+    return len(entries)
+
+class SingleFlight(Generic[T]):
+    """
+    同一个 key 同时只有一次上游请求: 第一个调用者发起, 后来的等同一个 future(防缓存击穿)
+    请求跑在独立的 task 里, 用 shield 等待, 某个等待者被取消(客户端断开)不会取消请求本身, 其他人照常拿到结果
+    请求抛出的异常原样抛给所有等待者; 结束后(成功或失败)马上从表里移除, 下一次调用重新请求
+    一个实例里所有 key 的 fn 必须返回同一种类型, 返回值不同的操作各用一个实例
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, "asyncio.Task[T]"] = {}
+
+    def __len__(self) -> int:
+        return len(self._inflight)
+
+    def start(self, key: str, fn: Callable[[], Awaitable[T]]) -> "asyncio.Task[T]":
+        """
+        key 没有在途请求时用 fn 发起一个, 返回在途的 task(不等待)
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        return await asyncio.shield(self.start(key, fn))
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 所有等待者都被取消时没人取结果, 这里取一次, 避免 "exception was never retrieved"
+        if not task.cancelled():
+            task.exception()
+
+# L1 未命中: _load 返回 (结果, 是否已过新鲜期)
+_flights: SingleFlight[Tuple[FetchResult, bool]] = SingleFlight()
+# 后台刷新单独一组: 刷新吞掉错误、返回值也不同, 未命中的请求不能去等它
+_revalidations: SingleFlight[Optional[FetchResult]] = SingleFlight()
 
 @lru_cache(maxsize=256)
 def _norm(u: str) -> str:
@@ -70,25 +529,116 @@ def _norm(u: str) -> str:
     return u.strip().lower()
 
 # ---------- app ----------
-app = FastAPI(title="Mini Async Service", version="0.1.0")
+app = FastAPI(title="Mini Async Service", version="0.1.0", lifespan=lifespan)
 
 @app.get("/health")
 async def health():
     return {"ok": True}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**_cache.stats(), "inflight": len(_flights), "revalidating": len(_revalidations), "l2": _l2.stats() if _l2 is not None else None}
+
 @app.get("/fetch", response_model=FetchResult)
 @timed
 async def fetch(url: str = Query(..., min_length=5), client: httpx.AsyncClient = Depends(get_client)):
-    key = _norm(url)
-    async with _lock:
-        if key in _cache:
-            return _cache[key]
+    return await _lookup(client, url, _norm(url))
+
+async def _lookup(client: httpx.AsyncClient, url: str, key: str,
+                  sem: Optional[asyncio.Semaphore] = None) -> FetchResult:
+    """
+    先查进程内缓存, 未命中再经 SingleFlight 查 L2、请求上游; sem 只限制 L1 未命中的请求, 命中缓存不占名额
+    """
+    # 查缓存和登记在途请求之间没有 await, 不会有两个请求同时发现未命中
+    res, stale = _cache.get(key)
+    if res is None:
+        if sem is None:
+            res, stale = await _flights.do(key, lambda: _load(client, url, key))
+        else:
+            async with sem:
+                res, stale = await _flights.do(key, lambda: _load(client, url, key))
+    if stale:
+        # 先返回旧值, 后台刷新; 已经在刷新时不会重复发起
+        _revalidations.start(key, lambda: _revalidate(client, url, key))
+    return res
+
+async def _load(client: httpx.AsyncClient, url: str, key: str) -> Tuple[FetchResult, bool]:
+    """
+    L1 未命中: 先查 L2, 命中就放进 L1; 否则请求上游。返回 (结果, 是否已过新鲜期)
+    """
+    if _l2 is not None:
+        entry = await _l2.get(key)
+        if entry is not None:
+            return entry[0], _promote(key, *entry)
+    return await _fetch_upstream(client, url, key), False
+
+@app.post("/fetch/batch")
+async def fetch_batch(req: BatchRequest, client: httpx.AsyncClient = Depends(get_client)):
+    """
+    返回 NDJSON, 每个 URL 一行, 哪个先完成先输出; 失败的行是 {"url", "error", "status_code"}
+    同一批里规范化后相同的 URL 只查一次, 结果按原样的每个 URL 各输出一行
+    """
+    groups: Dict[str, List[str]] = {}
+    for u in req.urls:
+        groups.setdefault(_norm(u), []).append(u)
+    limit = min(req.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY)
+    return StreamingResponse(_stream_batch(client, groups, limit), media_type="application/x-ndjson")
+
+async def _stream_batch(client: httpx.AsyncClient, groups: Dict[str, List[str]],
+                        limit: int) -> AsyncIterator[str]:
+    t0 = time.perf_counter()
+    sem = asyncio.Semaphore(limit)
+
+    async def one(key: str, urls: List[str]) -> Tuple[List[str], Optional[FetchResult], Optional[Exception]]:
+        try:
+            return urls, await _lookup(client, urls[0], key, sem), None
+        except Exception as e:
+            return urls, None, e
+
+    tasks = [asyncio.ensure_future(one(key, urls)) for key, urls in groups.items()]
+    errors = 0
+    try:
+        for fut in asyncio.as_completed(tasks):
+            urls, res, err = await fut
+            lines = []
+            for u in urls:
+                if res is not None:
+                    lines.append(json.dumps({**res.model_dump(), "url": u}, ensure_ascii=False))
+                    continue
+                errors += 1
+                if isinstance(err, HTTPException):
+                    lines.append(json.dumps({"url": u, "error": err.detail, "status_code": err.status_code}))
+                else:
+                    log.error(json.dumps({"event": "batch_error", "url": u, "error": repr(err)}))
+                    lines.append(json.dumps({"url": u, "error": "internal error", "status_code": 500}))
+            yield "\n".join(lines) + "\n"
+    finally:
+        # 客户端中途断开时取消剩下的; 已经在途的上游请求由 SingleFlight 保护, 会继续完成并写入缓存
+        for t in tasks:
+            t.cancel()
+        log.info(json.dumps({"event": "batch", "urls": sum(map(len, groups.values())), "unique": len(groups),
+                             "errors": errors, "ms": round((time.perf_counter() - t0) * 1000, 2)}))
+
+async def _fetch_upstream(client: httpx.AsyncClient, url: str, key: str) -> FetchResult:
     try:
         r = await client.get(url)
     except httpx.HTTPError as e:
         raise HTTPException(status_code=502, detail=f"upstream error: {e}") from e
 
     res = FetchResult(url=url, status=r.status_code, title=extract_title(r.text))
-    async with _lock:
-        _cache[key] = res
-    return res
\ No newline at end of file
+    policy = cache_policy(r.headers, r.status_code, _cache.cfg)
+    if policy is not None:
+        _cache.set(key, res, *policy)
+        if _l2 is not None:
+            await _l2.set(key, res, *policy)
+    return res
+
+async def _revalidate(client: httpx.AsyncClient, url: str, key: str) -> Optional[FetchResult]:
+    """
+    后台刷新, 失败时只记日志, 旧值在 stale 窗口内继续可用
+    """
+    try:
+        return await _fetch_upstream(client, url, key)
+    except HTTPException as e:
+        log.warning(json.dumps({"event": "revalidate_failed", "url": url, "detail": e.detail}))
+        return None
\ No newline at end of file